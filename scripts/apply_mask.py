@@ -5,17 +5,15 @@ import logging
 
 import numpy as np
 
-from skimage.io import use_plugin, imread, imsave
+from image_io import imread, imsave
 
 logger = logging.getLogger('__main__.{}'.format(__name__))
 
 def apply_mask(input_file, mask_file, output_file):
-    use_plugin('pil')
-
     # TODO - shape mismatches
 
-    input_image = imread(input_file)
-    mask_image = imread(mask_file)
+    input_image = imread(input_file, backend='pil')
+    mask_image = imread(mask_file, backend='pil')
 
     logger.info('Input image shape: {}'.format(input_image.shape))
     logger.info('Mask image shape: {}'.format(mask_image.shape))
@@ -33,7 +31,7 @@ def apply_mask(input_file, mask_file, output_file):
 
     output_image[output_locations] = input_image[mask_locations]
 
-    imsave(output_file, output_image)
+    imsave(output_file, output_image, backend='pil')
     
 
 def main():
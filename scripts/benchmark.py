@@ -0,0 +1,247 @@
+"""Time the stages of the pipeline on synthetic root stacks.
+
+The synthetic stacks are generated with known ground-truth labels, so no
+confocal data or Fiji installation is needed. Every stage is given inputs
+derived from the ground truth rather than from the output of the previous
+stage, so the stages are timed independently of each other.
+
+The per-slice stages are timed on the middle slice of the stack and the
+other stages on the whole stack. The timings are appended as JSON lines to
+an output file, one record per stage and input size, so that regressions
+and scaling curves can be compared across versions.
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import timeit
+from collections import namedtuple
+
+import numpy as np
+
+import logging
+from workflow import setup_logger
+logger = logging.getLogger('__main__.{}'.format(__name__))
+
+BENCHMARK_FNAME = 'benchmark.jsonl'
+
+# Voxels are this many times deeper than wide, so that cells extend over a
+# few z-slices; cells are elongated along the x axis of the root.
+Z_SCALE = 4.0
+X_SCALE = 0.5
+
+SyntheticRoot = namedtuple('SyntheticRoot',
+                           ['labels', 'cellwall', 'venus', 'root_mask'])
+
+def synthetic_root(xdim, ydim, zdim, num_cells, seed=0):
+    """Return a synthetic root stack with known cell labels.
+
+    The root is a band along the x axis of each slice. Its cells are the
+    Voronoi regions of random seed points, which gives tightly packed
+    cells with straight walls, roughly like a confocal stack of a root.
+
+    :returns: :class:`SyntheticRoot` of arrays of shape (z, x, y): uint16
+              ground-truth labels, uint8 cellwall and venus intensities,
+              and the 2D boolean root mask
+    """
+    from scipy.spatial import cKDTree
+    from segmentation_outline import outline_mask
+    rs = np.random.RandomState(seed)
+
+    half_width = ydim * 0.35
+    root_mask = np.zeros((xdim, ydim), dtype=bool)
+    root_mask[:, int(ydim/2 - half_width):int(ydim/2 + half_width)] = True
+
+    seeds = np.column_stack([
+        rs.uniform(0, zdim, num_cells) * Z_SCALE,
+        rs.uniform(0, xdim, num_cells) * X_SCALE,
+        rs.uniform(ydim/2 - half_width, ydim/2 + half_width, num_cells)])
+    tree = cKDTree(seeds)
+
+    labels = np.zeros((zdim, xdim, ydim), dtype=np.uint16)
+    xs, ys = np.nonzero(root_mask)
+    for z in range(zdim):
+        points = np.column_stack([np.full(len(xs), z * Z_SCALE),
+                                  xs * X_SCALE, ys])
+        _, nearest = tree.query(points)
+        labels[z, xs, ys] = nearest + 1
+
+    cell_intensity = rs.randint(20, 200, num_cells + 1).astype(np.uint8)
+    cell_intensity[0] = 0
+    cellwall = np.empty(labels.shape, dtype=np.uint8)
+    for z in range(zdim):
+        noise = rs.randint(0, 30, (xdim, ydim))
+        cellwall[z] = np.where(outline_mask(labels[z]), 200, 0) + noise
+    venus = cell_intensity.take(labels)
+    return SyntheticRoot(labels, cellwall, venus, root_mask)
+
+def time_call(repeat, func, *args, **kwargs):
+    """Return the shortest time in seconds of repeat calls of a function."""
+    best = None
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        func(*args, **kwargs)
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def _write_inputs(root, work_dir):
+    """Write the files read by the file based stages; return their paths."""
+    from image_io import imsave
+    z = len(root.labels) // 2
+    paths = {
+        'cellwall': os.path.join(work_dir, 'cellwall.tif'),
+        'mask': os.path.join(work_dir, 'mask.tif'),
+        'labels': os.path.join(work_dir, 'labels.tif'),
+    }
+    cellwall_rgb = np.zeros(root.cellwall.shape[1:] + (3,), dtype=np.uint8)
+    cellwall_rgb[:,:,0] = root.cellwall[z]
+    imsave(paths['cellwall'], cellwall_rgb, backend='pil')
+    imsave(paths['mask'], root.root_mask.astype(np.uint8) * 255, backend='pil')
+    imsave(paths['labels'], root.labels[z], backend='cv2')
+    return paths
+
+def _build_reconstruction(label_images, engine='pairwise'):
+    """Return the reconstruction of all the slices of a stack."""
+    from reconstructor import build_reconstruction, SegmentationMap
+    smaps = [SegmentationMap.from_array(im) for im in label_images]
+    return build_reconstruction(smaps, 0, len(smaps) - 1, engine)
+
+def benchmark_stages(root, work_dir, stages=None, repeat=3):
+    """Return list of (stage, unit, seconds) timings of the pipeline stages.
+
+    :param root: :class:`SyntheticRoot`
+    :param work_dir: directory for the image files written by the stages
+    :param stages: names of the stages to time; all stages by default
+    :param repeat: the shortest of this many runs is reported per stage
+    """
+    from object_mask import generate_object_mask
+    from apply_mask import apply_mask
+    from segmentation import color_objects
+    from tiling import TILE_SIZE
+    from remove_border_segmentations import remove_border_segmentations
+    from reconstructor import total_segmented_area, SegmentationMap
+    from reconstruct_and_measure import measure_cells, generate_reconstruction_mask
+
+    paths = _write_inputs(root, work_dir)
+    z = len(root.labels) // 2
+    label_images = list(root.labels)
+    intensity_images = list(root.venus)
+    # Fiji's binary output: dark cells on bright walls and background.
+    fiji_im = np.where((root.cellwall[z] > 100) | ~root.root_mask, 255, 0)
+
+    r = _build_reconstruction(label_images)
+    rcells = r.cells_larger_then(3)
+    area = total_segmented_area(SegmentationMap.from_array(im)
+                                for im in label_images)
+    mask_fpaths = [os.path.join(work_dir, 'da{:d}.tif'.format(i))
+                   for i in range(len(label_images))]
+
+    def out(fname):
+        return os.path.join(work_dir, fname)
+
+    all_stages = [
+        ('generate_object_mask', 'slice', lambda: generate_object_mask(
+            paths['cellwall'], out('object_mask.tif'), 1000, 6)),
+        ('apply_mask', 'slice', lambda: apply_mask(
+            paths['cellwall'], paths['mask'], out('masked.tif'))),
+        ('color_objects', 'slice', lambda: color_objects(fiji_im, 50)),
+        ('color_objects_tiled', 'slice', lambda: color_objects(
+            fiji_im, 50, tile_size=TILE_SIZE)),
+        ('remove_border_segmentations', 'slice', lambda: remove_border_segmentations(
+            paths['labels'], out('no_border.tif'))),
+        ('reconstruction', 'stack', lambda: _build_reconstruction(label_images)),
+        ('volume_reconstruction', 'stack', lambda: _build_reconstruction(
+            label_images, 'volume')),
+        ('measurement', 'stack', lambda: measure_cells(
+            rcells, intensity_images, area)),
+        ('mask_rendering', 'stack', lambda: generate_reconstruction_mask(
+            mask_fpaths, label_images, rcells, 0, len(label_images) - 1)),
+    ]
+    timings = []
+    for name, unit, func in all_stages:
+        if stages is not None and name not in stages:
+            continue
+        seconds = time_call(repeat, func)
+        logger.info('{}: {:.3f}s per {}'.format(name, seconds, unit))
+        timings.append((name, unit, seconds))
+    return timings
+
+def run_benchmark(sizes, zdim, cell_size, stages=None, repeat=3, seed=0,
+                  output_file=BENCHMARK_FNAME):
+    """Time the stages for each image size and append the results to a file.
+
+    :param sizes: widths of the square slices to benchmark
+    :param zdim: number of slices in the stacks
+    :param cell_size: mean width of a cell in pixels; the number of cells
+                      grows with the size of the root
+    :returns: list of the result records
+    """
+    records = []
+    for size in sizes:
+        root_voxels = size * size * 0.7 * zdim * Z_SCALE * X_SCALE
+        num_cells = max(1, int(root_voxels / cell_size**3))
+        logger.info('Size {0}x{0}x{1}, {2} cells'.format(size, zdim, num_cells))
+        root = synthetic_root(size, size, zdim, num_cells, seed)
+        work_dir = tempfile.mkdtemp(prefix='benchmark-')
+        try:
+            timings = benchmark_stages(root, work_dir, stages, repeat)
+        finally:
+            shutil.rmtree(work_dir)
+        for stage, unit, seconds in timings:
+            records.append({'stage': stage,
+                            'unit': unit,
+                            'seconds': seconds,
+                            'xdim': size,
+                            'ydim': size,
+                            'zdim': zdim,
+                            'num_cells': num_cells,
+                            'repeat': repeat,
+                            'time': time.time()})
+    with open(output_file, 'a') as fh:
+        for record in records:
+            fh.write(json.dumps(record, sort_keys=True) + '\n')
+    return records
+
+def print_records(records):
+    """Print a table of the timings of the stages per size."""
+    print('{:<28} {:>6} {:>5} {:>6} {:>10}'.format(
+        'stage', 'size', 'z', 'cells', 'seconds'))
+    for rec in records:
+        print('{:<28} {:>6} {:>5} {:>6} {:>10.3f}'.format(
+            rec['stage'], rec['xdim'], rec['zdim'], rec['num_cells'],
+            rec['seconds']))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024],
+                        help="Widths of the square slices")
+    parser.add_argument('--zdim', type=int, default=20,
+                        help="Number of slices in the stacks")
+    parser.add_argument('--cell_size', type=float, default=20,
+                        help="Mean width of a cell in pixels")
+    parser.add_argument('--stages', nargs='+', default=None,
+                        help="Stages to time (default all)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Report the shortest of this many runs")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the synthetic stacks")
+    parser.add_argument('--output', default=BENCHMARK_FNAME,
+                        help="File the results are appended to")
+    parser.add_argument('--verbose', action='store_true',
+                        help="Log the timing of each stage as it finishes")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger('__main__').setLevel(logging.INFO)
+    records = run_benchmark(args.sizes, args.zdim, args.cell_size,
+                            args.stages, args.repeat, args.seed, args.output)
+    print_records(records)
+
+if __name__ == '__main__':
+    setup_logger(__name__)
+    main()
@@ -3,21 +3,71 @@
 import os
 import argparse
 import random
+from collections import OrderedDict
+from multiprocessing import Pool
 
 import numpy as np
-from skimage.io import use_plugin, imread, imsave
 from skimage.morphology import disk, square, binary_erosion
 
-from libtiff import TIFF
-
 from time import time
 
-from reconstructor import (
-    Reconstruction,
-    load_segmentation_maps,
-    sorted_nicely,
-)
-from reconstruct_and_measure import load_intensity_data
+from reconstructor import Reconstruction, load_segmentation_maps
+from stack_io import load_images, DECODE_THREADS
+from image_io import write_rgb_tiff
+from workflow import PARTIAL_PREFIX
+
+# Number of loaded roots kept in memory and number of samples drawn from a
+# root each time it is selected.
+ROOT_CACHE_SIZE = 2
+SAMPLES_PER_ROOT = 10
+
+# Number of times samples that failed are planned again.
+MAX_ROUNDS = 5
+MAX_SEED = 2**31 - 1
+
+class RootData(object):
+    """Segmentations, images and reconstruction of one root."""
+
+    DECODE_THREADS = DECODE_THREADS
+
+    def __init__(self, seg_dir, cell_wall_dir, measurement_dir):
+        self.segmentation_maps = load_segmentation_maps(
+            seg_dir, RootData.DECODE_THREADS)
+        self.cell_wall_images = self.get_images(cell_wall_dir)
+        self.measurement_images = self.get_images(measurement_dir)
+        self.xdim, self.ydim = self.measurement_images[0].shape
+
+        start = time()
+        self.reconstruction = Reconstruction(self.segmentation_maps, start=0) 
+        for z in range(0, len(self.segmentation_maps)-1):
+            self.reconstruction.extend(z)
+        elapsed = ( time() - start ) / 60
+        print('Reconstruction done {} minutes.'.format(elapsed))
+
+    def get_images(self, directory):
+        """Return list of images sorted nicely."""
+        return load_images(directory, RootData.DECODE_THREADS)
+
+class RootCache(object):
+    """Loaded roots, discarding the least recently used beyond max_size."""
+
+    def __init__(self, max_size=ROOT_CACHE_SIZE):
+        self.max_size = max_size
+        self.roots = OrderedDict()
+
+    def get(self, seg_dir, cell_wall_dir, measurement_dir):
+        """Return the root data of the directories, loading it if needed."""
+        key = (seg_dir, cell_wall_dir, measurement_dir)
+        try:
+            root = self.roots.pop(key)
+        except KeyError:
+            # Drop the oldest roots before loading so that at most max_size
+            # roots are held in memory.
+            while self.roots and len(self.roots) >= self.max_size:
+                self.roots.popitem(last=False)
+            root = RootData(seg_dir, cell_wall_dir, measurement_dir)
+        self.roots[key] = root
+        return root
 
 class ValidationSet(object):
     """Class for generating a validation set."""
@@ -25,15 +75,31 @@ class ValidationSet(object):
     Z_FIRST = 3
     Z_LAST = 11
 
-    def __init__(self, seg_dir, cell_wall_dir, measurement_dir, out_dir, out_prefix):
-        use_plugin('freeimage')
-
+    # Markers of the selected points; the top left corner of a marker is
+    # drawn MARKER_SIZE pixels up and left of its point.
+    MARKER_SIZE = 6
+    IN_PLANE_MARKER = (disk(MARKER_SIZE) * 255).astype(np.uint8)
+    NOT_IN_PLANE_MARKER = (square(MARKER_SIZE) * 255).astype(np.uint8)
+
+    # Width of the answer outlines.
+    OUTLINE_RADIUS = 4
+    OUTLINE_SELEM = disk(OUTLINE_RADIUS)
+
+    def __init__(self, root, out_dir, out_prefix, rng=random, sampled_cells=None):
+        self.rng = rng
+        # IDs of the reconstructed cells already used in other samples.
+        if sampled_cells is None:
+            sampled_cells = set()
+        self.sampled_cells = sampled_cells
         self.reconstructed_cells = []
         self.selected_points = []
 
-        self.segmentation_maps = load_segmentation_maps(seg_dir)
-        self.cell_wall_images = self.get_images(cell_wall_dir)
-        self.measurement_images = self.get_images(measurement_dir)
+        self.root = root
+        self.segmentation_maps = root.segmentation_maps
+        self.cell_wall_images = root.cell_wall_images
+        self.measurement_images = root.measurement_images
+        self.reconstruction = root.reconstruction
+        self.xdim, self.ydim = root.xdim, root.ydim
         self.out_dir = out_dir
         self.out_prefix = out_prefix
 
@@ -44,120 +110,119 @@ class ValidationSet(object):
             if not os.path.isdir(d):
                 os.mkdir(d)
 
-        self.xdim, self.ydim = self.measurement_images[0].shape
-
-        start = time()
-        self.reconstruction = Reconstruction(self.segmentation_maps, start=0) 
-        for z in range(0, len(self.segmentation_maps)-1):
-            self.reconstruction.extend(z)
-        elapsed = ( time() - start ) / 60
-        print('Reconstruction done {} minutes.'.format(elapsed))
-
     def get_filename(self):
         """Return image file name."""
         rcell_id = self.reconstructed_cells[0].ID
         return '{}_rcell{}.tif'.format(self.out_prefix, rcell_id)
 
-    def get_images(self, directory):
-        """Return list of images sorted nicely."""
-        image_files = os.listdir(directory)
-        image_files = sorted_nicely(image_files)
-        idata = [imread(os.path.join(directory, im_file))
-                 for im_file in image_files]
-        return idata
-
-    def get_random_plane(self):
-        """Return a random plane (z) integer."""
-        return random.randint(ValidationSet.Z_FIRST, ValidationSet.Z_LAST)
-
-    def get_random_point(self):
-        """Return a random point (x, y) in a plane."""
-        x = random.randint(0, self.xdim-1)
-        y = random.randint(0, self.ydim-1)
-        return x, y
-
     def pick_reconstructed_cells(self):
-        """Pick cells to reconstruct."""
-        while len(self.reconstructed_cells) < 1:
-            z = self.get_random_plane()
-            x, y = self.get_random_point()
-            cell_id = self.segmentation_maps[z].cell_id_at((x,y))
-            rcell = self.reconstruction.find_cell(z, cell_id)
-            if (rcell is not None
-                and rcell.z_extent > 2
-                and rcell.z_extent < 7
-                and rcell not in self.reconstructed_cells):
-                print('rCell: {}'.format(rcell))
-                self.selected_points.append( (x, y, z) )
-                self.reconstructed_cells.append( rcell )
+        """Pick cells to reconstruct.
+
+        The selected point is a random pixel of the cells that can be picked:
+        the slices of reconstructed cells spanning three to six planes which
+        are not in sampled_cells, i.e. used in an earlier sample of the same
+        root. The cells of each plane are listed by its cell index.
+        """
+        cells = []
+        z_last = min(ValidationSet.Z_LAST, len(self.segmentation_maps) - 1)
+        for z in range(ValidationSet.Z_FIRST, z_last + 1):
+            index = self.segmentation_maps[z].cell_index
+            for cell_id, area in zip(index.ids, index.areas):
+                rcell = self.reconstruction.find_cell(z, cell_id)
+                if (rcell is not None
+                    and rcell.z_extent > 2
+                    and rcell.z_extent < 7
+                    and rcell.ID not in self.sampled_cells):
+                    cells.append((z, cell_id, rcell, area))
+        if not cells:
+            raise IndexError('No cell left to pick.')
+
+        offsets = np.cumsum([area for _, _, _, area in cells])
+        pixel = self.rng.randint(0, offsets[-1] - 1)
+        i = int(np.searchsorted(offsets, pixel, side='right'))
+        z, cell_id, rcell, area = cells[i]
+        cellslice = self.segmentation_maps[z].cells[cell_id]
+        k = pixel - (offsets[i] - area)
+        x, y = int(cellslice.x_coords[k]), int(cellslice.y_coords[k])
+
+        print('rCell: {}'.format(rcell))
+        self.selected_points.append( (x, y, z) )
+        self.reconstructed_cells.append( rcell )
+        self.sampled_cells.add( rcell.ID )
 
     def get_selected_points_image(self, z_plane):
-        """Return selected points image for a particular z-stack."""
-        size = 6
-        not_in_plane_symbol = square(size)
-        in_plane_symbol = disk(size)
-
-        def get_x_y_pixel_values(x, y, salem):
-            for i, ys in enumerate(salem):
-                for j, vals in enumerate(ys):
-                    pixel = salem[i,j] * 255
-                    xval = x + i - size
-                    yval = y + j - size
-                    yield (xval, yval, pixel)
+        """Return selected points image for a particular z-stack.
 
+        Points in the plane are marked with a disk, points in other planes
+        with a square. Markers are clipped at the image border.
+        """
+        size = ValidationSet.MARKER_SIZE
         im = np.zeros((self.xdim, self.ydim), dtype=np.uint8)
         for x, y, z in self.selected_points:
             if z == z_plane:
-                data = get_x_y_pixel_values(x, y, in_plane_symbol)
+                marker = ValidationSet.IN_PLANE_MARKER
             else:
-                data = get_x_y_pixel_values(x, y, not_in_plane_symbol)
-            for x, y, pixel in data:
-                im[x, y] = pixel
+                marker = ValidationSet.NOT_IN_PLANE_MARKER
+            stamp(im, marker, x - size, y - size)
         return im
 
+    def write_atomically(self, out_fname, images):
+        """Write rgb images to a partial file and rename it when complete."""
+        out_dir, fname = os.path.split(out_fname)
+        partial_fname = os.path.join(out_dir, PARTIAL_PREFIX + fname)
+        write_rgb_tiff(partial_fname, images)
+        os.rename(partial_fname, out_fname)
+
     def generate_augmented_image(self):
         """Generate augmented image with x,y,z points."""
         out_fname = os.path.join(self.segment_me_dir, self.get_filename())
-        tif = TIFF.open(out_fname, 'w')
-        for z, (cell_wall_im, measurement_im) in enumerate(zip(self.cell_wall_images,
-                                                self.measurement_images)):
-            point_im = self.get_selected_points_image(z)
-            aug_im_rgb = np.array([cell_wall_im, measurement_im, point_im])
-            tif.write_image(aug_im_rgb, write_rgb=True)
+        images = (np.array([cell_wall_im, measurement_im, self.get_selected_points_image(z)])
+                  for z, (cell_wall_im, measurement_im) in enumerate(zip(self.cell_wall_images,
+                                                         self.measurement_images)))
+        self.write_atomically(out_fname, images)
 
     def get_segmentation_outline_image(self, z_plane):
-        """Return segmentation_outline_image for a particular z-stack."""
-
-        def get_outline(im):
-            """Return segmentation outline."""
-            binary_mask_im = im != 0
-            salem = disk(4)
-            erosion_mask_im = binary_erosion(binary_mask_im, salem)
-            outline_mask_im = np.logical_xor(binary_mask_im, erosion_mask_im)
-            return im * outline_mask_im
+        """Return segmentation_outline_image for a particular z-stack.
+
+        The outline of a cell is the part of it that does not survive an
+        erosion of the selected cells. It only depends on pixels within
+        OUTLINE_RADIUS of the cell, so the erosion is done on the cell's
+        bounding box grown by that radius rather than on the whole plane.
+        """
+        r = ValidationSet.OUTLINE_RADIUS
+        cell_slices = [rcell.slice_dict[z_plane]
+                       for rcell in self.reconstructed_cells
+                       if z_plane in rcell.slice_dict]
 
         im = np.zeros((self.xdim, self.ydim), dtype=np.uint8)
-        for rcell in self.reconstructed_cells:
-            try:
-                cell_slice = rcell.slice_dict[z_plane]
-            except KeyError:
+        for cell_slice in cell_slices:
+            im[cell_slice.x_coords, cell_slice.y_coords] = 255
+
+        outline_im = np.zeros((self.xdim, self.ydim), dtype=np.uint8)
+        for cell_slice in cell_slices:
+            xs = np.asarray(cell_slice.x_coords)
+            ys = np.asarray(cell_slice.y_coords)
+            if len(xs) == 0:
                 continue
-            for x, y in zip(cell_slice.x_coords, cell_slice.y_coords):
-                im[x, y] = 255
-        return get_outline(im)
-
-
-        return im
+            x0, x1 = max(0, xs.min() - r), min(self.xdim, xs.max() + r + 1)
+            y0, y1 = max(0, ys.min() - r), min(self.ydim, ys.max() + r + 1)
+            mask = im[x0:x1, y0:y1] != 0
+            eroded = binary_erosion(mask, ValidationSet.OUTLINE_SELEM)
+            on_outline = ~eroded[xs - x0, ys - y0]
+            outline_im[xs[on_outline], ys[on_outline]] = 255
+        return outline_im
 
     def generate_answer_image(self):
-        """Generate image augmented with the answer."""
+        """Generate image augmented with the answer.
+
+        The answer is written last; a sample is complete once its answer
+        image exists.
+        """
         out_fname = os.path.join(self.answer_dir, self.get_filename())
-        tif = TIFF.open(out_fname, 'w')
-        for z, (cell_wall_im, measurement_im) in enumerate(zip(self.cell_wall_images,
-                                                self.measurement_images)):
-            seg_im = self.get_segmentation_outline_image(z)
-            aug_im_rgb = np.array([cell_wall_im, measurement_im, seg_im])
-            tif.write_image(aug_im_rgb, write_rgb=True)
+        images = (np.array([cell_wall_im, measurement_im, self.get_segmentation_outline_image(z)])
+                  for z, (cell_wall_im, measurement_im) in enumerate(zip(self.cell_wall_images,
+                                                         self.measurement_images)))
+        self.write_atomically(out_fname, images)
 
     def generate_validation_set(self):
         """Generate the validation images."""
@@ -165,7 +230,24 @@ class ValidationSet(object):
         self.generate_augmented_image()
         self.generate_answer_image()
 
-def select_random_root():
+def stamp(im, marker, x0, y0):
+    """Draw a marker onto an image with its top left corner at (x0, y0).
+
+    The marker is clipped to the image and combined with what is already
+    drawn by taking the maximum, so overlapping markers do not erase each
+    other.
+    """
+    xdim, ydim = im.shape
+    mx0, my0 = max(0, -x0), max(0, -y0)
+    x1 = min(xdim, x0 + marker.shape[0])
+    y1 = min(ydim, y0 + marker.shape[1])
+    x0, y0 = max(0, x0), max(0, y0)
+    if x1 <= x0 or y1 <= y0:
+        return
+    region = im[x0:x1, y0:y1]
+    np.maximum(region, marker[mx0:mx0+x1-x0, my0:my0+y1-y0], out=region)
+
+def select_random_root(rng=random):
     """Return tuple of input file paths to a random root."""
     base_dir = '/localscratch/olssont/flc_venus'
 
@@ -183,10 +265,10 @@ def select_random_root():
     def get_out_prefix(e, t, s):
         return '{}_{}_{}'.format(e, t, s)
 
-    e = random.choice(['SDB265', 'SDB281'])
-#   t = random.choice(['2WT7', '4WT7', '6WT7', '8WT7', '10WT7'])
-    t = random.choice(['2WT7', '4WT7'])
-    s = random.choice(['S0', 'S1', 'S2', 'S3', 'S4', 'S5'])
+    e = rng.choice(['SDB265', 'SDB281'])
+#   t = rng.choice(['2WT7', '4WT7', '6WT7', '8WT7', '10WT7'])
+    t = rng.choice(['2WT7', '4WT7'])
+    s = rng.choice(['S0', 'S1', 'S2', 'S3', 'S4', 'S5'])
 
     return (
         get_seg_dir(e, t, s),
@@ -197,35 +279,167 @@ def select_random_root():
         
 
 def get_validation_set_size(out_dir):
+    return len(get_sample_ids(out_dir))
+
+def get_sample_ids(out_dir):
+    """Return set of the ids of the complete samples in the output directory."""
     d = os.path.join(out_dir, 'answers')
     try:
         fnames = os.listdir(d)
     except OSError:
-        return 0
-    return len(fnames)
-    
-def generate_validation_set(out_dir, size):
-    print('out_dir', out_dir)
-    print(get_validation_set_size(out_dir) < size)
-    while get_validation_set_size(out_dir) < size:
-        identifier = get_validation_set_size(out_dir)
-        s_dir, cw_dir, m_dir, out_prefix = select_random_root()
-        print('Done: {}'.format(identifier))
-        out_prefix = '{:03d}_{}'.format(identifier, out_prefix)
-        print(s_dir, cw_dir, m_dir, out_prefix)
+        return set()
+    ids = set()
+    for fname in fnames:
+        prefix = fname.split('_', 1)[0]
+        if prefix.isdigit():
+            ids.add(int(prefix))
+    return ids
+
+def get_sampled_cells(out_dir):
+    """Return dictionary of root prefix -> set of the IDs of the sampled cells.
+
+    Parsed from the names of the complete samples in the output directory,
+    '<id>_<root prefix>_rcell<rcell id>.tif'.
+    """
+    d = os.path.join(out_dir, 'answers')
+    try:
+        fnames = os.listdir(d)
+    except OSError:
+        return {}
+    sampled = {}
+    for fname in fnames:
+        parts = fname.split('_', 1)
+        if len(parts) != 2 or not parts[0].isdigit():
+            continue
+        root_prefix, sep, rcell = os.path.splitext(parts[1])[0].rpartition('_rcell')
+        if sep and rcell.isdigit():
+            sampled.setdefault(root_prefix, set()).add(int(rcell))
+    return sampled
+
+def plan_batches(sample_ids, samples_per_root, rng):
+    """Return list of (sample ids, root, seed) batches.
+
+    Every samples_per_root samples are drawn from a randomly selected root.
+    The samples of a root selected more than once are merged into one
+    batch, so that a cell is never sampled twice by batches running at the
+    same time. Each batch has a random stream seeded by its own seed. The
+    ids are handed out here, so workers never have to agree on them.
+    """
+    sample_ids = sorted(sample_ids)
+    batches = OrderedDict()
+    for i in range(0, len(sample_ids), samples_per_root):
+        root = select_random_root(rng)
+        seed = rng.randint(0, MAX_SEED)
+        ids, _ = batches.setdefault(root, ([], seed))
+        ids.extend(sample_ids[i:i+samples_per_root])
+    return [(ids, root, seed) for root, (ids, seed) in batches.items()]
+
+_worker_roots = None
+
+# Errors of a sample or root that fail the sample rather than the run.
+SAMPLE_ERRORS = (IOError, OSError, IndexError, ValueError)
+
+def generate_batch(out_dir, sample_ids, root_dirs, seed, sampled_cells=()):
+    """Generate the samples of a batch.
+
+    Roots stay cached in the worker process between batches. A cell is
+    used at most once per root; what a batch picks only depends on its
+    seed and the cells sampled before, not on the batches the worker ran
+    before.
+
+    :param sampled_cells: IDs of the cells of the root in earlier samples
+    :returns: tuple of (ids generated, list of (id, root, error) failures)
+    """
+    global _worker_roots
+    if _worker_roots is None:
+        _worker_roots = RootCache()
+    s_dir, cw_dir, m_dir, root_prefix = root_dirs
+    rng = random.Random(seed)
+    sampled_cells = set(sampled_cells)
+    done = []
+    failures = []
+    try:
+        root = _worker_roots.get(s_dir, cw_dir, m_dir)
+    except SAMPLE_ERRORS as e:
+        return done, [(identifier, root_prefix, str(e)) for identifier in sample_ids]
+    for identifier in sample_ids:
+        out_prefix = '{:03d}_{}'.format(identifier, root_prefix)
         try:
-            vs = ValidationSet(s_dir, cw_dir, m_dir, out_dir, out_prefix)
+            vs = ValidationSet(root, out_dir, out_prefix, rng, sampled_cells)
             vs.generate_validation_set()
-        except (OSError, IndexError):
-            pass
+            done.append(identifier)
+        except SAMPLE_ERRORS as e:
+            failures.append((identifier, root_prefix, str(e)))
+    return done, failures
+
+def _generate_batch(args):
+    """Unpack the arguments of :func:`generate_batch` for Pool.imap."""
+    return generate_batch(*args)
+
+def generate_validation_set(out_dir, size, samples_per_root=SAMPLES_PER_ROOT,
+                            seed=0, num_workers=1, max_rounds=MAX_ROUNDS):
+    """Generate validation samples until there are size of them.
+
+    The samples missing from the output directory are split into batches
+    of up to samples_per_root samples drawn from one root. The batches and
+    their random streams are planned from the seed up front, so the same
+    seed and starting directory give the same set whatever the number of
+    workers. Cells already in the output directory are not sampled again.
+    Samples that fail are reported and planned again, up to max_rounds
+    times.
+
+    :returns: list of (id, root, error) of the samples that failed in the
+              last round
+    """
+    print('out_dir', out_dir)
+    for d in (out_dir, os.path.join(out_dir, 'segment_me'),
+              os.path.join(out_dir, 'answers')):
+        if not os.path.isdir(d):
+            os.mkdir(d)
+
+    rng = random.Random(seed)
+    pool = Pool(num_workers) if num_workers > 1 else None
+    mapper = pool.imap_unordered if pool is not None else map
+    failures = []
+    try:
+        for round_num in range(max_rounds):
+            missing = set(range(size)) - get_sample_ids(out_dir)
+            if not missing:
+                break
+            batches = plan_batches(missing, samples_per_root, rng)
+            sampled = get_sampled_cells(out_dir)
+            print('Round {}: {} samples in {} batches'.format(
+                round_num, len(missing), len(batches)))
+            failures = []
+            for done, batch_failures in mapper(_generate_batch,
+                    [(out_dir,) + batch + (sampled.get(batch[1][3], set()),)
+                     for batch in batches]):
+                print('Done: {}'.format(done))
+                for failure in batch_failures:
+                    print('Failed: {} {}: {}'.format(*failure))
+                failures.extend(batch_failures)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    failures.sort()
+    if failures:
+        print('{} samples failed'.format(len(failures)))
+    return failures
 
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('out_dir', help="Path to output directory")
     parser.add_argument('size', type=int, help="Size of the validation set")
+    parser.add_argument('--samples_per_root', type=int, default=SAMPLES_PER_ROOT,
+                        help="Number of samples drawn from a root each time it is selected")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the random selection of roots and cells")
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help="Number of worker processes")
     args = parser.parse_args()
-    generate_validation_set(args.out_dir, args.size)
+    generate_validation_set(args.out_dir, args.size, args.samples_per_root,
+                            args.seed, args.num_workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,245 @@
+"""Reading and writing of image files with explicit backends.
+
+skimage selects its I/O plugin with ``use_plugin``, which changes state
+shared by every thread in the process. The functions here never switch
+plugins; every call names its backend, which is chosen from the file format
+unless it is given explicitly.
+
+Backends:
+
+- ``freeimage``: skimage's freeimage plugin; reads and writes 16-bit label
+  images and rgb images without converting them
+- ``pil``: skimage's pil plugin; 8-bit grey and rgb images
+- ``cv2``: OpenCV, reading images unchanged so 16-bit images keep their
+  dtype; channels are in BGR order so use it for grey and label images
+- ``labels``: label files, see :mod:`label_store`; label files are always
+  read and written with this backend
+"""
+
+import os
+import struct
+import threading
+
+import numpy as np
+
+from label_store import LABEL_SUFFIX, is_label_file, write_labels, LabelImage
+
+import logging
+logger = logging.getLogger('__main__.{}'.format(__name__))
+
+SKIMAGE_BACKENDS = ('freeimage', 'pil')
+BACKENDS = SKIMAGE_BACKENDS + ('cv2', 'labels')
+
+DEFAULT_BACKEND = 'freeimage'
+FORMAT_BACKENDS = {
+    '.tif': 'freeimage',
+    '.tiff': 'freeimage',
+    '.png': 'pil',
+    '.jpg': 'pil',
+    '.jpeg': 'pil',
+    LABEL_SUFFIX: 'labels',
+}
+
+# skimage loads a plugin the first time it is named, which is not thread
+# safe; plugins are loaded once under a lock.
+_loaded_plugins = set()
+_plugin_lock = threading.Lock()
+
+def backend_for(fpath, backend=None):
+    """Return the name of the backend used for a file.
+
+    :param fpath: image file path
+    :param backend: backend to use for image files; by default it is chosen
+                    from the file extension
+    """
+    if is_label_file(fpath):
+        return 'labels'
+    if backend is None:
+        ext = os.path.splitext(fpath)[1].lower()
+        return FORMAT_BACKENDS.get(ext, DEFAULT_BACKEND)
+    if backend not in BACKENDS:
+        raise ValueError('Unknown image backend: {}'.format(backend))
+    return backend
+
+def load_plugin(plugin):
+    """Load a skimage plugin without making it the default plugin."""
+    if plugin in _loaded_plugins:
+        return
+    with _plugin_lock:
+        if plugin not in _loaded_plugins:
+            from skimage.io._plugins.plugin import _load
+            _load(plugin)
+            _loaded_plugins.add(plugin)
+
+def load_backends(backends=SKIMAGE_BACKENDS):
+    """Import the libraries of the backends up front, e.g. in a worker."""
+    for backend in backends:
+        if backend in SKIMAGE_BACKENDS:
+            load_plugin(backend)
+        elif backend == 'cv2':
+            import cv2
+
+def _check_out(out, im):
+    """Raise ValueError if the output buffer does not fit the image."""
+    if out.shape != im.shape or out.dtype != im.dtype:
+        raise ValueError('Output buffer {} {} does not match image {} {}.'.format(
+            out.shape, out.dtype, im.shape, im.dtype))
+
+def _skimage_read(fpath, plugin):
+    import skimage.io
+    load_plugin(plugin)
+    return skimage.io.imread(fpath, plugin=plugin)
+
+def _skimage_write(fpath, im, plugin):
+    import skimage.io
+    load_plugin(plugin)
+    skimage.io.imsave(fpath, im, plugin=plugin)
+
+def _cv2_read(fpath):
+    import cv2
+    im = cv2.imread(fpath, -1)
+    if im is None:
+        raise IOError('Could not read image: {}'.format(fpath))
+    return im
+
+def _cv2_write(fpath, im):
+    import cv2
+    if not cv2.imwrite(fpath, im):
+        raise IOError('Could not write image: {}'.format(fpath))
+
+def imread(fpath, backend=None, out=None):
+    """Return the image in a file with the dtype it is stored in.
+
+    :param fpath: image or label file path
+    :param backend: backend to use for image files, see :func:`backend_for`
+    :param out: optional array the image is read into; it must have the
+                shape and dtype of the image
+    :returns: numpy array; out if given
+    """
+    backend = backend_for(fpath, backend)
+    if backend == 'labels':
+        return LabelImage(fpath).read(out=out)
+    if backend == 'cv2':
+        im = _cv2_read(fpath)
+    else:
+        im = _skimage_read(fpath, backend)
+    if out is None:
+        return im
+    _check_out(out, im)
+    out[...] = im
+    return out
+
+# (SampleFormat, BitsPerSample) of the tiff data types that can be mapped.
+TIFF_DTYPES = {
+    (1, 8): 'u1', (1, 16): 'u2', (1, 32): 'u4',
+    (2, 8): 'i1', (2, 16): 'i2', (2, 32): 'i4',
+    (3, 32): 'f4', (3, 64): 'f8',
+}
+# Sizes and struct codes of the SHORT and LONG tiff field types.
+TIFF_FIELD_TYPES = {3: 'H', 4: 'I'}
+
+def _tiff_layout(fpath):
+    """Return (offset, dtype, shape) of the image data of a tiff file.
+
+    Only the first image of uncompressed grey or rgb tiff files with the
+    samples of each pixel together and the strips one after the other can
+    be mapped; None is returned for any other file.
+    """
+    with open(fpath, 'rb') as fh:
+        byte_order = {'II': '<', 'MM': '>'}.get(fh.read(2))
+        if byte_order is None:
+            return None
+        magic, ifd_offset = struct.unpack(byte_order + 'HI', fh.read(6))
+        if magic != 42:
+            return None
+        fh.seek(ifd_offset)
+        num_entries, = struct.unpack(byte_order + 'H', fh.read(2))
+        entries = [struct.unpack(byte_order + 'HHI4s', fh.read(12))
+                   for _ in range(num_entries)]
+
+        tags = {}
+        for tag, field_type, count, value in entries:
+            if field_type not in TIFF_FIELD_TYPES:
+                continue
+            code = byte_order + TIFF_FIELD_TYPES[field_type] * count
+            size = struct.calcsize(code)
+            if size > 4:
+                fh.seek(struct.unpack(byte_order + 'I', value)[0])
+                value = fh.read(size)
+            tags[tag] = struct.unpack(code, value[:size])
+
+    def tag_value(tag, default=None):
+        return tags.get(tag, (default,))[0]
+
+    if 273 not in tags or 322 in tags:
+        # No strips, or the image is stored in tiles.
+        return None
+    samples = tag_value(277, 1)
+    bits = set(tags.get(258, (1,)))
+    if (tag_value(259, 1) != 1 or tag_value(284, 1) != 1
+            or tag_value(262) not in (1, 2) or len(bits) != 1):
+        return None
+    dtype = TIFF_DTYPES.get((tag_value(339, 1), bits.pop()))
+    if dtype is None:
+        return None
+    dtype = np.dtype(byte_order + dtype)
+
+    shape = (tag_value(257), tag_value(256))
+    if samples > 1:
+        shape += (samples,)
+    offsets, counts = tags[273], tags.get(279, ())
+    if len(offsets) != len(counts):
+        return None
+    for offset, count, next_offset in zip(offsets, counts, offsets[1:]):
+        if offset + count != next_offset:
+            return None
+    if sum(counts) != dtype.itemsize * np.prod(shape):
+        return None
+    return offsets[0], dtype, shape
+
+def imread_mapped(fpath, backend=None):
+    """Return the image in a file, memory mapped if possible.
+
+    Uncompressed tiff files are memory mapped, so that the image can be
+    processed in parts without reading all of it; other files are read
+    with :func:`imread`.
+
+    :param fpath: image or label file path
+    :param backend: backend to use for files that can not be mapped
+    """
+    layout = None
+    if os.path.splitext(fpath)[1].lower() in ('.tif', '.tiff'):
+        layout = _tiff_layout(fpath)
+    if layout is None:
+        return imread(fpath, backend)
+    offset, dtype, shape = layout
+    return np.memmap(fpath, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+def imsave(fpath, im, backend=None):
+    """Write an image to a file without changing its dtype.
+
+    :param fpath: image or label file path
+    :param im: numpy array
+    :param backend: backend to use for image files, see :func:`backend_for`
+    """
+    backend = backend_for(fpath, backend)
+    if backend == 'labels':
+        write_labels(fpath, im)
+    elif backend == 'cv2':
+        _cv2_write(fpath, im)
+    else:
+        _skimage_write(fpath, im, backend)
+
+def write_rgb_tiff(fpath, images):
+    """Write a sequence of rgb images to a multi-page tiff file.
+
+    :param fpath: output file path
+    :param images: iterable of arrays of shape (3, x, y)
+    """
+    from libtiff import TIFF
+    tif = TIFF.open(fpath, 'w')
+    try:
+        for im in images:
+            tif.write_image(im, write_rgb=True)
+    finally:
+        tif.close()
@@ -0,0 +1,209 @@
+"""Chunked, compressed storage for label images.
+
+Segmentations are mostly zeros or long runs of the same label, which
+compress very well. A label file stores a 2D label image as a grid of
+tiles that are compressed separately with zlib, so that a single tile can
+be read without decoding the whole image. Tiles that are all zeros are
+not stored at all.
+
+File layout:
+
+- 8 bytes magic string
+- 4 bytes little-endian unsigned int: length of the JSON header
+- JSON header with the dtype, shape, tile size, number of non-zero pixels,
+  the extension of the image file the labels were written from and the
+  (offset, length) of each tile in row-major order
+- compressed tiles
+"""
+
+import os
+import json
+import zlib
+import struct
+import argparse
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('__main__.{}'.format(__name__))
+
+LABEL_SUFFIX = '.labels'
+MAGIC = 'RIALABEL'
+TILE_SIZE = 256
+COMPRESSION_LEVEL = 1
+DEFAULT_IMAGE_EXT = '.tif'
+
+def is_label_file(path):
+    """Wether or not the path is a label file."""
+    return path.endswith(LABEL_SUFFIX)
+
+def label_fname(fname):
+    """Return the label file name corresponding to an image file name."""
+    return os.path.splitext(fname)[0] + LABEL_SUFFIX
+
+def image_fname(fpath):
+    """Return the image file path corresponding to a label file path.
+
+    The extension is that of the image the label file was written from,
+    which is read from the header of the label file; it is '.tif' if the
+    label file does not exist (yet) or does not record it.
+    """
+    if not is_label_file(fpath):
+        return fpath
+    image_ext = DEFAULT_IMAGE_EXT
+    try:
+        header, _ = read_header(fpath)
+        image_ext = str(header.get('image_ext', DEFAULT_IMAGE_EXT))
+    except IOError:
+        pass
+    return os.path.splitext(fpath)[0] + image_ext
+
+def _tile_slices(shape, tile_size):
+    """Yield (x slice, y slice) of the tiles in row-major order."""
+    xdim, ydim = shape
+    for x0 in range(0, xdim, tile_size):
+        for y0 in range(0, ydim, tile_size):
+            yield (slice(x0, min(x0 + tile_size, xdim)),
+                   slice(y0, min(y0 + tile_size, ydim)))
+
+def read_header(fpath):
+    """Return the header dictionary and the offset of the data.
+
+    :raises: IOError if the file can not be read or is not a label file
+    """
+    with open(fpath, 'rb') as fh:
+        magic = fh.read(len(MAGIC))
+        if magic != MAGIC:
+            raise IOError('Not a label file: {}'.format(fpath))
+        header_len, = struct.unpack('<I', fh.read(4))
+        header = json.loads(fh.read(header_len))
+    return header, len(MAGIC) + 4 + header_len
+
+def write_labels(fpath, im, tile_size=TILE_SIZE, image_ext=DEFAULT_IMAGE_EXT):
+    """Write a 2D label image to a label file.
+
+    :param image_ext: extension of the image file the labels replace, see
+                      :func:`image_fname`
+    """
+    im = np.asarray(im)
+    if im.ndim != 2:
+        raise ValueError('Label images must be 2D.')
+    chunks = []
+    table = []
+    offset = 0
+    for xs, ys in _tile_slices(im.shape, tile_size):
+        tile = im[xs, ys]
+        if not tile.any():
+            table.append([offset, 0])
+            continue
+        data = zlib.compress(np.ascontiguousarray(tile).tostring(),
+                             COMPRESSION_LEVEL)
+        chunks.append(data)
+        table.append([offset, len(data)])
+        offset += len(data)
+    header = json.dumps({'dtype': im.dtype.str,
+                         'shape': list(im.shape),
+                         'tile_size': tile_size,
+                         'nonzero': int(np.count_nonzero(im)),
+                         'image_ext': image_ext,
+                         'chunks': table})
+    with open(fpath, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack('<I', len(header)))
+        fh.write(header)
+        for data in chunks:
+            fh.write(data)
+
+class LabelImage(object):
+    """Label image stored in a label file, read lazily tile by tile.
+
+    Tiles read on their own are cached, so looking up many positions
+    decodes each tile at most once.
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        header, self.data_offset = read_header(fpath)
+        self.dtype = np.dtype(header['dtype'])
+        self.shape = tuple(header['shape'])
+        self.tile_size = header['tile_size']
+        self.nonzero = header['nonzero']
+        self.chunks = header['chunks']
+        self.tiles_per_row = -(-self.shape[1] // self.tile_size)
+        self._tiles = {}
+
+    def _tile_shape(self, ti, tj):
+        """Return the shape of tile (ti, tj); edge tiles can be smaller."""
+        xdim, ydim = self.shape
+        return (min(self.tile_size, xdim - ti * self.tile_size),
+                min(self.tile_size, ydim - tj * self.tile_size))
+
+    def _decode(self, fh, ti, tj):
+        """Return the array of tile (ti, tj) read from an open file."""
+        offset, length = self.chunks[ti * self.tiles_per_row + tj]
+        shape = self._tile_shape(ti, tj)
+        if length == 0:
+            return np.zeros(shape, dtype=self.dtype)
+        fh.seek(self.data_offset + offset)
+        data = zlib.decompress(fh.read(length))
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+    def read_tile(self, ti, tj):
+        """Return the (read-only) array of tile (ti, tj)."""
+        key = (ti, tj)
+        if key not in self._tiles:
+            with open(self.fpath, 'rb') as fh:
+                self._tiles[key] = self._decode(fh, ti, tj)
+        return self._tiles[key]
+
+    def read_region(self, x0, x1, y0, y1, out=None):
+        """Return the region [x0:x1, y0:y1] decoding only the tiles needed.
+
+        The region is written into out if it is given; it must have the
+        shape and dtype of the region.
+        """
+        ts = self.tile_size
+        shape = (x1 - x0, y1 - y0)
+        if out is None:
+            region = np.empty(shape, dtype=self.dtype)
+        elif out.shape != shape or out.dtype != self.dtype:
+            raise ValueError('Output buffer {} {} does not match region {} {}.'.format(
+                out.shape, out.dtype, shape, self.dtype))
+        else:
+            region = out
+        with open(self.fpath, 'rb') as fh:
+            for ti in range(x0 // ts, -(-x1 // ts)):
+                for tj in range(y0 // ts, -(-y1 // ts)):
+                    tile = self._decode(fh, ti, tj)
+                    tx0, ty0 = ti * ts, tj * ts
+                    ax0, ax1 = max(x0, tx0), min(x1, tx0 + tile.shape[0])
+                    ay0, ay1 = max(y0, ty0), min(y1, ty0 + tile.shape[1])
+                    region[ax0-x0:ax1-x0, ay0-y0:ay1-y0] = \
+                        tile[ax0-tx0:ax1-tx0, ay0-ty0:ay1-ty0]
+        return region
+
+    def read(self, out=None):
+        """Return the whole label image, written into out if given."""
+        return self.read_region(0, self.shape[0], 0, self.shape[1], out)
+
+    def value_at(self, position):
+        """Return the label at position (x, y)."""
+        x, y = position
+        ts = self.tile_size
+        return self.read_tile(x // ts, y // ts)[x % ts, y % ts]
+
+def read_labels(fpath):
+    """Return the label image stored in a label file."""
+    return LabelImage(fpath).read()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('input_file', help="Label image (e.g. 16-bit tif)")
+    parser.add_argument('output_file', help="Output label file")
+    args = parser.parse_args()
+    from image_io import imread
+    write_labels(args.output_file, imread(args.input_file),
+                 image_ext=os.path.splitext(args.input_file)[1])
+
+if __name__ == '__main__':
+    main()
@@ -8,8 +8,6 @@ import os
 import argparse
 import logging
 import numpy as np
-import matplotlib.pyplot as plt
-import PIL.Image
 import scipy.ndimage
 import skimage.io
 import skimage.color
@@ -17,6 +15,8 @@ import skimage.filter
 import skimage.morphology
 import time
 
+import image_io
+
 logger = logging.getLogger('__main__.{}'.format(__name__))
 #logger.addHandler(logging.StreamHandler())
 #logger.setLevel(logging.DEBUG)
@@ -24,9 +24,11 @@ logger = logging.getLogger('__main__.{}'.format(__name__))
 def imshow(image):
     """Display the image.
     
-    For debugging purposes.
+    For debugging purposes. Matplotlib is only imported when debugging is
+    enabled as it is slow to import.
     """
     if logger.isEnabledFor(logging.DEBUG):
+        import matplotlib.pyplot as plt
         skimage.io.imshow(image)
         plt.show()
 
@@ -34,10 +36,13 @@ def inverse(image):
     "Return the negative image."
     return 1 - image
 
+SMOOTH_SIGMA = 1
+ERODE_SIZE = 50
+
 def get_object_mask_image(img, min_size, dilate_size):
     "Return binary image of the object mask."
     logger.info('gaussian...')
-    img = skimage.filter.gaussian_filter(img, 1)
+    img = skimage.filter.gaussian_filter(img, SMOOTH_SIGMA)
     imshow(img)
 
     logger.info('threshold...')
@@ -67,12 +72,95 @@ def get_object_mask_image(img, min_size, dilate_size):
     imshow(img)
 
     logger.info('erode...')
-    salem = skimage.morphology.disk(50)
+    salem = skimage.morphology.disk(ERODE_SIZE)
     img = skimage.morphology.binary_erosion(img, salem)
     imshow(img)
 
     return img
 
+def otsu_threshold(hist, bin_centers):
+    """Return the Otsu threshold of an image from its histogram.
+
+    The same threshold as that of skimage.filter.threshold_otsu given the
+    histogram of the image over its range in 256 bins.
+    """
+    hist = hist.astype(float)
+    weight1 = np.cumsum(hist)
+    weight2 = np.cumsum(hist[::-1])[::-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean1 = np.cumsum(hist * bin_centers) / weight1
+        mean2 = (np.cumsum((hist * bin_centers)[::-1]) / weight2[::-1])[::-1]
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return bin_centers[:-1][np.nanargmax(variance12)]
+
+def get_object_mask_image_tiled(img, min_size, dilate_size, tile_size,
+                                mapper=map):
+    """Return binary image of the object mask computed in tiles.
+
+    The smoothing, thresholding and the dilation and erosion are done tile
+    by tile with a halo of the radius of the filter, which gives the same
+    result as :func:`get_object_mask_image` while only the binary
+    intermediate images cover the whole image. The Otsu threshold is
+    computed from the histograms of the smoothed tiles. Filling the holes,
+    removing the small objects and the convex hull need the whole binary
+    image.
+
+    :param img: grey or rgb image; it can be a memory mapped array
+    :param tile_size: width of the tiles
+    :param mapper: map function used to process the tiles, see
+                   :func:`tiling.tile_map`
+    """
+    from tiling import map_tiles
+    smooth_halo = int(4 * SMOOTH_SIGMA + 0.5)
+
+    def smooth(tile):
+        return skimage.filter.gaussian_filter(get_grey_image(tile), SMOOTH_SIGMA)
+
+    # The smoothed tiles are recomputed in each pass rather than kept, which
+    # would take a float image the size of the whole image.
+    logger.info('gaussian and threshold in tiles of {}...'.format(tile_size))
+    lo, hi = np.inf, -np.inf
+    for core in _smoothed_cores(smooth, img, tile_size, smooth_halo, mapper):
+        lo, hi = min(lo, core.min()), max(hi, core.max())
+    hist = np.zeros(256, dtype=np.int64)
+    for core in _smoothed_cores(smooth, img, tile_size, smooth_halo, mapper):
+        hist += np.histogram(core, bins=256, range=(lo, hi))[0]
+    edges = np.linspace(lo, hi, 257)
+    threshold = otsu_threshold(hist, (edges[:-1] + edges[1:]) / 2)
+    img = map_tiles(lambda tile: smooth(tile) > threshold, img, tile_size,
+                    smooth_halo, mapper=mapper)
+
+    logger.info('fill holes...')
+    img = scipy.ndimage.binary_fill_holes(img)
+
+    logger.info('remove small objects (<{})...'.format(min_size))
+    img = skimage.morphology.remove_small_objects(img, min_size=min_size)
+
+    logger.info('dilate {}...'.format(dilate_size))
+    salem = skimage.morphology.disk(dilate_size)
+    img = map_tiles(lambda tile: skimage.morphology.binary_dilation(tile, salem),
+                    img, tile_size, dilate_size, mapper=mapper)
+
+    logger.info('convex hull...')
+    img = skimage.morphology.convex_hull_image(img)
+
+    logger.info('erode...')
+    salem = skimage.morphology.disk(ERODE_SIZE)
+    img = map_tiles(lambda tile: skimage.morphology.binary_erosion(tile, salem),
+                    img, tile_size, ERODE_SIZE, mapper=mapper)
+
+    return img
+
+def _smoothed_cores(smooth, img, tile_size, halo, mapper=map):
+    """Return iterator over the cores of the smoothed tiles of an image."""
+    from tiling import iter_tiles, map_lazily
+
+    def smooth_core(tile):
+        return smooth(img[tile.padded])[tile.inner]
+
+    tiles = list(iter_tiles(img.shape, tile_size, halo))
+    return map_lazily(mapper, smooth_core, tiles)
+
 def get_grey_image(img):
     """Return 2D array image.
 
@@ -92,22 +180,33 @@ def get_color_image(img):
     """
     return img * 255
 
-def generate_object_mask(input_fn, output_fn, min_size, dilate_size):
-    skimage.io.use_plugin('pil')
-    img = skimage.io.imread(input_fn)
-    img = get_grey_image(img)
-    img = get_object_mask_image(img, min_size, dilate_size)
+def generate_object_mask(input_fn, output_fn, min_size, dilate_size,
+                         tile_size=None, tile_threads=1):
+    """Write the object mask of an image.
+
+    If tile_size is given the mask is computed in tiles of the input, which
+    is memory mapped if it is an uncompressed tiff file, spread over
+    tile_threads threads.
+    """
+    if tile_size is not None:
+        from tiling import tile_map
+        img = image_io.imread_mapped(input_fn, backend='pil')
+        with tile_map(tile_threads) as mapper:
+            img = get_object_mask_image_tiled(img, min_size, dilate_size,
+                                              tile_size, mapper)
+    else:
+        img = image_io.imread(input_fn, backend='pil')
+        img = get_grey_image(img)
+        img = get_object_mask_image(img, min_size, dilate_size)
     img = get_color_image(img)
-    skimage.io.imsave(output_fn, img)
+    image_io.imsave(output_fn, img, backend='pil')
 
 
-def main(input_fn, output_fn, min_size, dilate_size):
+def main(input_fn, output_fn, min_size, dilate_size, tile_size=None,
+         tile_threads=1):
     "The control logic of the script."
-    img = skimage.io.imread(input_fn)
-    img = get_grey_image(img)
-    img = get_object_mask_image(img, min_size, dilate_size)
-    img = get_color_image(img)
-    skimage.io.imsave(output_fn, img)
+    generate_object_mask(input_fn, output_fn, min_size, dilate_size, tile_size,
+                         tile_threads)
 
 if __name__ == '__main__':
     "Parse the command line arguments."
@@ -122,7 +221,16 @@ if __name__ == '__main__':
         default=6,
         type=int,
         help='how much to dilate after having removed small objects')
+    parser.add_argument('--tile_size',
+        default=None,
+        type=int,
+        help='process the image in tiles of this size')
+    parser.add_argument('--tile_threads',
+        default=1,
+        type=int,
+        help='number of threads processing the tiles')
     args = parser.parse_args()
     if not os.path.isfile(args.input_file):
         parser.error('No such file: {}'.format(args.input_file))
-    main(args.input_file, args.output_file, args.min_size, args.dilate_size)
+    main(args.input_file, args.output_file, args.min_size, args.dilate_size,
+         args.tile_size, args.tile_threads)
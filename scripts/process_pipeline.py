@@ -6,18 +6,34 @@ from workflow import (
     ManyToManyNode,
     ManyToOneNode,
     BaseSettings,
+    FilePath,
+    ResourceScheduler,
+    Profiling,
+    Task,
+    memory_tracing_available,
     setup_logger,
+    dir_index,
 )
 from object_mask import generate_object_mask
 from apply_mask import apply_mask
 from segmentation import full_segment_image
 from remove_border_segmentations import remove_border_segmentations
-from reconstruct_and_measure import reconstruct_and_measure
-from sum_segmentation_dir import sum_segmentation_dir
+from reconstruct_and_measure import (
+    reconstruct_and_measure,
+    measure_reconstruction,
+    results_dtype,
+    channel_names,
+)
+from reconstructor import sorted_nicely, saved_reconstruction_settings
+from stack_io import STACK_SUFFIX, channel_path, pack_files
+from label_store import label_fname, image_fname, is_label_file
 from segmentation_outline import generate_segmentation_outline
+from warm_worker import warm_pool
 
 import logging
 from time import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 node_logger = logging.getLogger('workflow')
 node_logger.setLevel(logging.INFO)
@@ -39,25 +55,38 @@ class RootMask(ManyToManyNode):
     class Settings(BaseSettings):
         min_size = 1000
         dilate = 6
+        tile_size = None
+        tile_threads = 1
     
     def execute(self, task_input):
         generate_object_mask(task_input.input_file, task_input.output_file,
                              task_input.settings.min_size,
-                             task_input.settings.dilate)
+                             task_input.settings.dilate,
+                             task_input.settings.tile_size,
+                             task_input.settings.tile_threads)
 
 class ApplyMask(ManyToManyNode):
     """Apply the root mask to the cell wall image."""
+    def is_up_to_date(self, cell_wall_fname, mask_fname):
+        """Wether or not the output for the input pair is up to date."""
+        out_fname = self.get_output_file(cell_wall_fname)
+        return self.output_is_up_to_date(out_fname, cell_wall_fname, mask_fname)
+
+    def stale_outputs(self):
+        return [self.get_output_file(cell_wall_fname)
+                for cell_wall_fname, mask_fname in self.input_files
+                if not self.is_up_to_date(cell_wall_fname, mask_fname)]
+
     def process(self):
         for cell_wall_fname, mask_fname in self.input_files:
             out_fname = self.get_output_file(cell_wall_fname)
             log_msg(self, (cell_wall_fname, mask_fname))
-            if out_fname.exists \
-            and out_fname.is_more_recent_than(cell_wall_fname) \
-            and out_fname.is_more_recent_than(mask_fname):
+            if self.is_up_to_date(cell_wall_fname, mask_fname):
                 script_logger.info('Output file {} exists; skipping.'.format(out_fname))
                 continue
             script_logger.info('Processing input.')
-            apply_mask(cell_wall_fname, mask_fname, out_fname)
+            with self.atomic_output(out_fname) as partial_fname:
+                apply_mask(cell_wall_fname, mask_fname, partial_fname)
             script_logger.info('Done! Ouput file: {}.'.format(out_fname))
 
 class Segmentation(ManyToManyNode):
@@ -66,41 +95,267 @@ class Segmentation(ManyToManyNode):
         fiji_exe = '/usr/users/a5/olssont/software/fiji/Fiji.app/ImageJ-linux64'  
         fiji_script = os.path.join(HERE, 'watershed.ijm')
         min_num_pixels = 200
+        resource_class = 'fiji'
+        tile_size = None
+        tile_threads = 1
 
     def execute(self, task_input):
         full_segment_image(task_input.input_file,
                            task_input.output_file,
                            task_input.settings.fiji_exe,
                            task_input.settings.fiji_script,
-                           task_input.settings.min_num_pixels)
+                           task_input.settings.min_num_pixels,
+                           task_input.settings.tile_size,
+                           task_input.settings.tile_threads)
         
 
 class RemoveBorderSegmentations(ManyToManyNode):
     """Remove segments that touch the image border."""
+    class Settings(BaseSettings):
+        label_store = False
+
+    def get_output_file(self, fname, enumerator=None):
+        output_file = ManyToManyNode.get_output_file(self, fname, enumerator)
+        if self.settings.label_store:
+            output_file = FilePath(label_fname(output_file))
+        return output_file
+
+    @property
+    def output_files(self):
+        """Return the output files in the format of the label_store setting."""
+        return [fpath for fpath in ManyToManyNode.output_files.fget(self)
+                if is_label_file(fpath) == bool(self.settings.label_store)]
+
     def execute(self, task_input):
         remove_border_segmentations(task_input.input_file, task_input.output_file)
+        # Remove the slice written in the other format by an earlier run, so
+        # that the directory holds each slice once.
+        output_file = task_input.output_file
+        if is_label_file(output_file):
+            other_file = os.path.join(os.path.dirname(output_file),
+                                      os.path.basename(task_input.input_file))
+        else:
+            other_file = label_fname(output_file)
+        if os.path.isfile(other_file):
+            os.unlink(other_file)
+
+class SegmentationStack(ManyToOneNode):
+    """Pack the segmentations into a single stack file."""
+    def __init__(self, input_obj):
+        ManyToOneNode.__init__(self, input_obj, output_obj=None)
+
+    @property
+    def output_file(self):
+        return FilePath(os.path.join(self.output_directory,
+                                     'segmentation' + STACK_SUFFIX))
+
+    def is_up_to_date(self):
+        """Wether or not the stack file is up to date."""
+        return self.output_is_up_to_date(self.output_file, *self.input_files)
+
+    def stale_outputs(self):
+        if self.is_up_to_date():
+            return []
+        return [self.output_file]
+
+    def process(self):
+        out_fname = self.output_file
+        if self.is_up_to_date():
+            script_logger.info('Output file {} exists; skipping.'.format(out_fname))
+            return
+        script_logger.info('Processing input.')
+        with self.atomic_output(out_fname) as partial_fname:
+            pack_files(sorted_nicely(self.input_files), partial_fname)
+        script_logger.info('Done! Ouput file: {}.'.format(out_fname))
 
 class NewMeasurement(ManyToOneNode):
     """Measure the mean, quartile and best intensities of the segmented cells."""
     class Settings(BaseSettings):
         start_z = None
         end_z = None
+        columnar_results = True
+        emit_outlines = False
+        resource_class = 'measurement'
+        engine = 'pairwise'
+
+    @property
+    def segmentation_source(self):
+        """Return the directory or stack file containing the segmentations."""
+        segmentation_node = self.input_obj[0]
+        if isinstance(segmentation_node, SegmentationStack):
+            return segmentation_node.output_file
+        return segmentation_node.output_directory
+
+    @property
+    def reconstruction_file(self):
+        """Return the path of the saved reconstruction."""
+        return FilePath(os.path.join(os.path.dirname(self.output_file),
+                                     'reconstruction.npz'))
+
+    @property
+    def outline_directory(self):
+        """Return the directory the outlines are written to if emitted.
+
+        This is the directory of the ReconstrucitonOutline node, which then
+        finds its outputs up to date.
+        """
+        return os.path.join(os.path.dirname(self.output_directory),
+                            ReconstrucitonOutline.__name__)
+
+    @property
+    def columnar_file(self):
+        """Return the path of the columnar (npz) results file."""
+        return FilePath(os.path.splitext(self.output_file)[0] + '.npz')
+
+    def segmentation_fpaths(self):
+        """Return the segmentation file paths nicely sorted by file name."""
+        segmentation_node = self.input_obj[0]
+        if isinstance(segmentation_node, SegmentationStack):
+            fpaths = segmentation_node.input_files
+        else:
+            fpaths = segmentation_node.output_files
+        by_name = dict((os.path.basename(fp), fp) for fp in fpaths)
+        return [by_name[fname] for fname in sorted_nicely(by_name.keys())]
+
+    @property
+    def segmentation_file(self):
+        """Return the segmentation file the outputs are compared with."""
+        segmentation_node = self.input_obj[0]
+        if isinstance(segmentation_node, SegmentationStack):
+            return segmentation_node.output_file
+        return segmentation_node.output_files[0]
+
+    def channel_columns(self):
+        """Return the columns of the results of the intensity channels."""
+        return list(results_dtype(channel_names(self.input_obj[1:])).names)
+
+    def results_columns(self):
+        """Return the columns in the header of the results file."""
+        with open(self.output_file) as fh:
+            return fh.readline().strip().split(',')
+
+    def reconstruction_settings(self, fpaths=None):
+        """Return (engine, start_z, end_z) to build the reconstruction with.
+
+        :param fpaths: segmentation file paths, see :func:`segmentation_fpaths`
+        """
+        start_z = self.settings.start_z
+        if start_z is None:
+            start_z = 0
+        end_z = self.settings.end_z
+        if end_z is None:
+            if fpaths is None:
+                fpaths = self.segmentation_fpaths()
+            end_z = len(fpaths) - 1
+        return self.settings.engine, start_z, end_z
+
+    def reconstruction_matches_settings(self):
+        """Wether or not the saved reconstruction was built with the engine
+        and z range of the settings."""
+        if not dir_index.isfile(self.reconstruction_file):
+            return False
+        try:
+            saved = saved_reconstruction_settings(self.reconstruction_file)
+        except (IOError, KeyError, ValueError):
+            return False
+        return saved == self.reconstruction_settings()
+
+    def is_up_to_date(self):
+        """Wether or not the results file is up to date.
+
+        The results must be newer than the segmentation and have the
+        columns of the intensity channels, so that adding or removing a
+        channel measures the cells again. The reconstruction they were
+        measured from must have been built with the current engine and z
+        range.
+        """
+        return (self.output_is_up_to_date(self.output_file, self.segmentation_file)
+                and self.results_columns() == self.channel_columns()
+                and self.reconstruction_matches_settings())
+
+    def reconstruction_is_up_to_date(self):
+        """Wether or not the saved reconstruction is up to date.
+
+        It must be newer than the segmentation and built with the current
+        engine and z range. If it is, e.g. when only the channels changed,
+        the cells are measured from it rather than reconstructed again.
+        """
+        return (self.output_is_up_to_date(self.reconstruction_file,
+                                          self.segmentation_file)
+                and self.reconstruction_matches_settings())
+
+    def stale_outputs(self):
+        if self.is_up_to_date():
+            return []
+        fpaths = self.segmentation_fpaths()
+        _, start_z, end_z = self.reconstruction_settings(fpaths)
+        mask_fnames = [os.path.basename(image_fname(fp))
+                       for fp in fpaths[start_z:end_z+1]]
+        mask_fpaths = [os.path.join(self.output_directory, fname)
+                       for fname in mask_fnames]
+        if self.settings.emit_outlines:
+            mask_fpaths += [os.path.join(self.outline_directory, fname)
+                            for fname in mask_fnames]
+        outputs = [self.output_file]
+        if not self.reconstruction_is_up_to_date():
+            outputs.append(self.reconstruction_file)
+        if self.settings.columnar_results:
+            outputs.append(self.columnar_file)
+        return [outputs + mask_fpaths]
+
+    @property
+    def intensity_source(self):
+        """Return the directory or stack file of the intensity images.
+
+        A list of those of each channel if there are several channels.
+        """
+        intensity_dirs = list(self.input_obj[1:])
+        if len(intensity_dirs) == 1:
+            return intensity_dirs[0]
+        return intensity_dirs
+
     def process(self):
-        segmentation_dir = self.input_obj[0].output_directory
-        venus_dir = self.input_obj[1]
+        segmentation_dir = self.segmentation_source
+        intensity_source = self.intensity_source
         out_fname = self.output_file
-        log_msg(self, (segmentation_dir, venus_dir))
-        if out_fname.exists \
-        and out_fname.is_more_recent_than(self.input_obj[0].output_files[0]):
+        log_msg(self, (segmentation_dir, intensity_source))
+        if self.is_up_to_date():
             script_logger.info('Output file {} exists; skipping.'.format(out_fname))
             return
         script_logger.info('Processing input.')
-        reconstruct_and_measure(segmentation_dir,
-                                venus_dir,
-                                self.output_directory,
-                                out_fname,
-                                self.settings.start_z,
-                                self.settings.end_z)
+        # The results file is written last; writing it atomically means that
+        # an interrupted measurement is always redone.
+        with self.atomic_output(out_fname) as partial_fname, \
+             self.atomic_output(self.columnar_file) as partial_columnar_fname:
+            if not self.settings.columnar_results:
+                partial_columnar_fname = None
+            outline_dir = None
+            if self.settings.emit_outlines:
+                outline_dir = self.outline_directory
+            if self.reconstruction_is_up_to_date():
+                script_logger.info('Measuring the cells of {}.'.format(
+                    self.reconstruction_file))
+                measure_reconstruction(self.reconstruction_file,
+                                       segmentation_dir,
+                                       intensity_source,
+                                       self.output_directory,
+                                       partial_fname,
+                                       columnar_file=partial_columnar_fname,
+                                       outline_dir=outline_dir,
+                                       atomic_output=self.atomic_output)
+            else:
+                with self.atomic_output(self.reconstruction_file) as partial_recon_fname:
+                    reconstruct_and_measure(segmentation_dir,
+                                            intensity_source,
+                                            self.output_directory,
+                                            partial_fname,
+                                            self.settings.start_z,
+                                            self.settings.end_z,
+                                            reconstruction_file=partial_recon_fname,
+                                            columnar_file=partial_columnar_fname,
+                                            outline_dir=outline_dir,
+                                            engine=self.settings.engine,
+                                            atomic_output=self.atomic_output)
         script_logger.info('Done! Ouput file: {}.'.format(out_fname))
 
 class ReconstrucitonOutline(ManyToManyNode):
@@ -108,20 +363,27 @@ class ReconstrucitonOutline(ManyToManyNode):
     def get_tasks(self):
         tasks = []
         input_dir = self.input_obj.output_directory
-        for fname in os.listdir(input_dir):
+        for fname in dir_index.listdir(input_dir):
             input_fn = os.path.join(input_dir, fname)
             output_fn = self.get_output_file(fname)
-            tasks.append((input_fn, output_fn))
+            if self.output_is_up_to_date(output_fn, input_fn):
+                continue
+            tasks.append(Task(input_fn, output_fn, self.settings))
         return tasks
 
     def execute(self, task_input):
-        generate_segmentation_outline(task_input[0], task_input[1])
+        generate_segmentation_outline(task_input.input_file,
+                                      task_input.output_file)
 
 class Master(ManyToOneNode):
     """End to end workflow."""
+
+    # Whether or not to pack the segmentations into a stack file.
+    use_stacks = False
+
     def configure(self):
         cell_wall_dir = self.input_obj[0]
-        venus_dir = self.input_obj[1]
+        intensity_dirs = tuple(self.input_obj[1:])
         results_csv_fn = self.output_obj
 
         root_mask_node = self.add_node(RootMask(cell_wall_dir))
@@ -129,62 +391,198 @@ class Master(ManyToOneNode):
                                        input_obj=(cell_wall_dir, root_mask_node)))
         segmentation_node = self.add_node(Segmentation(apply_mask_node))
         remove_border_segmentation_node = self.add_node(RemoveBorderSegmentations(segmentation_node))
+        measurement_input_node = remove_border_segmentation_node
+        if self.use_stacks:
+            measurement_input_node = self.add_node(SegmentationStack(
+                                       remove_border_segmentation_node))
         new_measurement_node = self.add_node(NewMeasurement(
-                                       input_obj=(remove_border_segmentation_node, venus_dir),
+                                       input_obj=(measurement_input_node,) + intensity_dirs,
                                        output_obj=results_csv_fn))
         reconstruction_outline = self.add_node(ReconstrucitonOutline(
                                                input_obj=new_measurement_node))
 
-def process_pipeline(root_dir, out_dir, mapper):
+class StackMaster(Master):
+    """End to end workflow measuring from a segmentation stack file."""
+    use_stacks = True
+
+def process_pipeline(root_dir, out_dir, mapper, dry_run=False,
+                     use_stacks=False, use_label_store=False,
+                     emit_outlines=False, profiling=None, trace_memory=False,
+                     tile_size=None, channels=('venus',), tile_threads=1):
     cell_wall_dir = os.path.join(root_dir, 'cellwall')
-    venus_dir = os.path.join(root_dir, 'venus')
+    intensity_dirs = tuple(channel_path(root_dir, channel) for channel in channels)
     output_file = os.path.join(out_dir, 'final_results.csv')
 
-    master_node = Master(input_obj=(cell_wall_dir, venus_dir),
+    master_class = StackMaster if use_stacks else Master
+    master_node = master_class(input_obj=(cell_wall_dir,) + intensity_dirs,
                          output_obj=output_file)
     master_node.output_directory = out_dir
-    run(master_node, mapper)
+    for node in master_node.nodes:
+        if isinstance(node, RemoveBorderSegmentations):
+            node.settings.label_store = use_label_store
+        if isinstance(node, NewMeasurement):
+            node.settings.emit_outlines = emit_outlines
+        if isinstance(node, (RootMask, Segmentation)):
+            node.settings.tile_size = tile_size
+            node.settings.tile_threads = tile_threads
+    return run(master_node, mapper, dry_run=dry_run, profiling=profiling,
+               trace_memory=trace_memory)
 
-def process_many_series(root_dir, out_dir, mapper):
-    series_dirs = [d for d in os.listdir(root_dir) if d.startswith('S')]
+def process_many_series(root_dir, out_dir, mapper, dry_run=False,
+                        concurrent_series=1, use_stacks=False,
+                        use_label_store=False, emit_outlines=False,
+                        profiling=None, trace_memory=False, tile_size=None,
+                        channels=('venus',), tile_threads=1):
+    """Process all the series in a treatment directory.
 
-    for sd in series_dirs:
+    :param concurrent_series: number of series processed at the same time,
+                              each from its own thread sharing the mapper
+    """
+    series_dirs = [d for d in dir_index.listdir(root_dir) if d.startswith('S')]
+
+    def process_series(sd):
         new_root_dir = os.path.join(root_dir, sd)
         new_out_dir = os.path.join(out_dir, sd)
-        if not os.path.isdir(new_out_dir):
+        if not dry_run and not os.path.isdir(new_out_dir):
             os.mkdir(new_out_dir)
         script_logger.info('Processing series in: {}'.format(new_out_dir))
-        process_pipeline(new_root_dir, new_out_dir, mapper)
+        return new_out_dir, process_pipeline(new_root_dir, new_out_dir,
+                                             mapper, dry_run, use_stacks,
+                                             use_label_store, emit_outlines,
+                                             profiling, trace_memory,
+                                             tile_size, channels, tile_threads)
+
+    if concurrent_series > 1 and not dry_run:
+        thread_pool = ThreadPool(concurrent_series)
+        try:
+            return dict(thread_pool.map(process_series, series_dirs))
+        finally:
+            thread_pool.close()
+    return dict(map(process_series, series_dirs))
 
-def process_many_treatments(root_dir, out_dir, mapper):
-    treatment_dirs = os.listdir(root_dir)
+def process_many_treatments(root_dir, out_dir, mapper, dry_run=False,
+                            concurrent_series=1, use_stacks=False,
+                            use_label_store=False, emit_outlines=False,
+                            profiling=None, trace_memory=False,
+                            tile_size=None, channels=('venus',),
+                            tile_threads=1):
+    treatment_dirs = dir_index.listdir(root_dir)
 
+    plans = {}
     for td in treatment_dirs:
         new_root_dir = os.path.join(root_dir, td)
         new_out_dir = os.path.join(out_dir, td)
-        if not os.path.isdir(new_out_dir):
+        if not dry_run and not os.path.isdir(new_out_dir):
             os.mkdir(new_out_dir)
         script_logger.info('Processing treatment in: {}'.format(new_out_dir))
-        process_many_series(new_root_dir, new_out_dir, mapper)
+        plans.update(process_many_series(new_root_dir, new_out_dir,
+                                         mapper, dry_run, concurrent_series,
+                                         use_stacks, use_label_store,
+                                         emit_outlines, profiling,
+                                         trace_memory, tile_size, channels,
+                                         tile_threads))
+    return plans
+
+def report_plans(plans):
+    """Log the stale tasks per series and per node from dry runs."""
+    totals = OrderedDict()
+    for series in sorted(plans.keys()):
+        for entry in plans[series]:
+            script_logger.info('{}: {} {} stale task(s), estimate {} s'.format(
+                series, entry.node, entry.num_tasks, entry.estimated_seconds))
+            num_tasks, seconds = totals.get(entry.node, (0, 0.0))
+            if entry.num_tasks is not None:
+                num_tasks += entry.num_tasks
+            if entry.estimated_seconds is not None:
+                seconds += entry.estimated_seconds
+            totals[entry.node] = (num_tasks, seconds)
+    for node, (num_tasks, seconds) in totals.items():
+        script_logger.info('Total {}: {} stale task(s), estimate {:.1f} s'.format(
+            node, num_tasks, seconds))
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('root_dir', help="Root of directory structure containing files to process")
     parser.add_argument('out_dir', help="Output directory")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Report the stale tasks without processing anything")
+    parser.add_argument('--num_workers', default=1, type=int,
+                        help="Number of worker processes")
+    parser.add_argument('--fiji_slots', default=2, type=int,
+                        help="Maximum number of concurrent Fiji tasks")
+    parser.add_argument('--concurrent_series', default=1, type=int,
+                        help="Number of series to process at the same time")
+    parser.add_argument('--stacks', action='store_true',
+                        help="Pack the segmentations into stack files")
+    parser.add_argument('--label_store', action='store_true',
+                        help="Store the segmentations as compressed label files")
+    parser.add_argument('--emit_outlines', action='store_true',
+                        help="Render the outlines along with the reconstruction masks")
+    parser.add_argument('--profile', nargs='*', default=None, metavar='NODE',
+                        help="Profile the given nodes, or all nodes if none are given")
+    parser.add_argument('--profile_fraction', default=1.0, type=float,
+                        help="Fraction of the tasks of a node that are profiled")
+    parser.add_argument('--memory_limit', default=None, type=int,
+                        help="Memory (MB) available to concurrent tasks")
+    parser.add_argument('--measurement_memory', default=4000, type=int,
+                        help="Memory (MB) needed by a measurement task")
+    parser.add_argument('--trace_memory', action='store_true',
+                        help="Report the peak memory allocated by the tasks using tracemalloc")
+    parser.add_argument('--tile_size', default=None, type=int,
+                        help="Process the root mask and the segmentation labels in tiles of this size")
+    parser.add_argument('--tile_threads', default=1, type=int,
+                        help="Number of threads processing the tiles of a slice")
+    parser.add_argument('--channels', nargs='+', default=['venus'],
+                        help="Intensity channels to measure")
 
     args = parser.parse_args()
+    if args.trace_memory and not memory_tracing_available():
+        parser.error('--trace_memory needs tracemalloc (Python 3.4 or later)')
 
-    from multiprocessing import Pool
-    num_workers = 5
-    pool = Pool(num_workers)
+    if args.dry_run:
+        plans = process_many_treatments(args.root_dir, args.out_dir, map,
+                                        dry_run=True, use_stacks=args.stacks,
+                                        use_label_store=args.label_store,
+                                        emit_outlines=args.emit_outlines,
+                                        channels=args.channels)
+        report_plans(plans)
+        return
+
+    num_workers = args.num_workers
+    mapper = map
+    pool = None
+    if num_workers > 1:
+        pool = warm_pool(num_workers)
+    if pool is not None or args.memory_limit is not None:
+        mapper = ResourceScheduler(pool, {'fiji': args.fiji_slots},
+                                   memory_limit_mb=args.memory_limit,
+                                   memory_budgets={'measurement': args.measurement_memory})
+
+    profiling = None
+    if args.profile is not None:
+        profiling = Profiling(args.profile or None, args.profile_fraction)
 
     start = time()
-    process_many_treatments(args.root_dir, args.out_dir, map)
+    process_many_treatments(args.root_dir, args.out_dir, mapper,
+                            concurrent_series=args.concurrent_series,
+                            use_stacks=args.stacks,
+                            use_label_store=args.label_store,
+                            emit_outlines=args.emit_outlines,
+                            profiling=profiling,
+                            trace_memory=args.trace_memory,
+                            tile_size=args.tile_size,
+                            channels=args.channels,
+                            tile_threads=args.tile_threads)
 #   process_many_series(args.root_dir, args.out_dir, pool.map)
 #   process_pipeline(args.root_dir, args.out_dir, mapper=pool.map)
 
     elapsed = (time() - start) / 60
     script_logger.info('Time taken {:.3f} minutes, using {} cores.'.format(elapsed, num_workers))
+
+    if profiling is not None:
+        profile_dir = os.path.join(args.out_dir, 'profile')
+        profiling.dump(profile_dir)
+        script_logger.info('Profile report written to: {}'.format(profile_dir))
     
 
 
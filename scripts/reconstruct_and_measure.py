@@ -1,93 +1,268 @@
 """Generate partial 3D reconstruction from series of 2D slices"""
 
 
-import re
 import os
 import argparse
+from contextlib import closing, contextmanager
 
-import random
 import numpy as np
-from skimage.io import use_plugin, imread, imsave
-import matplotlib.pyplot as plt
 
-from reconstructor import Reconstruction, load_segmentation_maps
-from sum_segmentation_dir import sum_segmentation_dir
+from reconstructor import (
+    Reconstruction,
+    SegmentationMap,
+    ENGINES,
+    build_reconstruction,
+    load_segmentation_maps,
+    total_segmented_area,
+)
+from stack_io import (
+    STACK_SUFFIX,
+    is_stack,
+    slice_names,
+    load_images,
+    DECODE_THREADS,
+)
+from label_store import image_fname
+from segmentation_outline import outline_mask
+from image_io import imsave
 
 import logging
 logger = logging.getLogger('__main__.{}'.format(__name__))
 
-def sorted_nicely( l ):
-    """ Sort the given iterable in the way that humans expect."""
-    convert = lambda text: int(text) if text.isdigit() else text
-    alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ]
-    return sorted(l, key = alphanum_key)
-
-def shades_of_jop():
-    """Return a pretty colour."""
-    c1 = random.randint(127, 255) 
-    c2 = random.randint(0, 127) 
-    c3 = random.randint(0, 255) 
-
-    return tuple(random.sample([c1, c2, c3], 3))
-
-SHADES_OF_JOP_USED = set()
-def shades_of_jop_unique():
-    """Return a unique pretty colour."""
-    jop = shades_of_jop()
-    if jop in SHADES_OF_JOP_USED:
-        jop = shades_of_jop_unique()
-    else:
-        SHADES_OF_JOP_USED.add(jop)
-    return jop
+def shades_of_jop_palette(num_colours, seed=0):
+    """Return palette of unique pretty colours.
+
+    The colours are drawn deterministically from the seed. Each colour has
+    one channel in 127-255, one in 0-127 and one in 0-255, in random order,
+    so none of them is black.
+
+    :returns: (num_colours+1, 3) uint8 array; entry 0 is black (background)
+    """
+    rng = np.random.RandomState(seed)
+    colours = np.zeros((0, 3), dtype=np.int64)
+    while len(colours) < num_colours:
+        num_draws = 2 * (num_colours - len(colours)) + 16
+        draws = np.column_stack([rng.randint(127, 256, num_draws),
+                                 rng.randint(0, 128, num_draws),
+                                 rng.randint(0, 256, num_draws)])
+        permutations = rng.rand(num_draws, 3).argsort(axis=1)
+        draws = draws[np.arange(num_draws)[:, np.newaxis], permutations]
+        colours = np.vstack([colours, draws])
+        # Drop repeated colours, keeping the first occurrence.
+        codes = colours[:, 0] * 65536 + colours[:, 1] * 256 + colours[:, 2]
+        _, first = np.unique(codes, return_index=True)
+        colours = colours[np.sort(first)]
+    palette = np.zeros((num_colours+1, 3), dtype=np.uint8)
+    palette[1:] = colours[:num_colours]
+    return palette
 
 def get_mask_output_fpaths(seg_dir, out_dir, start_z, end_z):
     """Return list of reconstruction mask output file paths."""
-    fnames = os.listdir(seg_dir)
-    fnames = sorted_nicely(fnames)
+    fnames = [os.path.basename(image_fname(os.path.join(seg_dir, fn)))
+              for fn in slice_names(seg_dir)]
     fpaths = [os.path.join(out_dir, fn) for fn in fnames]
     return fpaths[start_z:end_z+1]  # Plus one is intentional; end_z goes to z-1
 
-def generate_reconstruction_mask(out_fpaths, xdim, ydim, rcells, start_z, end_z):
-    """Generate reconstruction mask."""
-    use_plugin('freeimage')
+def reconstruction_luts(label_images, rcells, start_z, end_z):
+    """Return dictionary of z -> lookup table from labels to palette index.
 
-    das = {z: np.zeros((xdim, ydim, 3), dtype=np.uint8)
-           for z in range(start_z, end_z+1)}  # Plus one is intentional; end goes to z-1
-
-    for rcell in rcells:
-        c = shades_of_jop_unique()
+    Reconstructed cell i is coloured by palette entry i+1; labels that are
+    not part of any of the reconstructed cells map to 0 (background).
+    """
+    luts = {}
+    for z in range(start_z, end_z+1):  # Plus one is intentional; end goes to z-1
+        luts[z] = np.zeros(int(label_images[z].max())+1, dtype=np.int64)
+    for i, rcell in enumerate(rcells):
         for z, cellslice in rcell.slice_dict.items():
-            das[z][cellslice.coord_list] = c
+            if z in luts:
+                luts[z][cellslice.ID] = i+1
+    return luts
+
+@contextmanager
+def direct_output(fpath):
+    """Context manager yielding the output path itself."""
+    yield fpath
+
+def generate_reconstruction_mask(out_fpaths, label_images, rcells, start_z, end_z,
+                                 outline_fpaths=None, atomic_output=None):
+    """Generate reconstruction mask.
+
+    Each z-plane is rendered from its label image with a single lookup. If
+    outline_fpaths are given the outlines of the reconstructed cells are
+    rendered in the same pass; each outline is written after its mask.
+
+    :param atomic_output: optional context manager yielding the path to
+                          write an output file to, e.g. the atomic_output of
+                          a workflow node, which also journals the output;
+                          by default the files are written directly
+    """
+    if atomic_output is None:
+        atomic_output = direct_output
+    palette = shades_of_jop_palette(len(rcells))
+    luts = reconstruction_luts(label_images, rcells, start_z, end_z)
 
     for out_fn, z in zip(out_fpaths, range(start_z, end_z+1)):
 #       out_fn = os.path.join(out_dir, "da%d.tif" % z)
-        imsave(out_fn, das[z])
-        
-
-def load_intensity_data(intensity_dir):
-    
-    image_files = os.listdir(intensity_dir)
-
-    image_files = sorted_nicely(image_files)
-
-    idata = [imread(os.path.join(intensity_dir, im_file))
-             for im_file in image_files]
-
-    return idata
+        rcell_im = luts[z].take(label_images[z])
+        with atomic_output(out_fn) as fpath:
+            imsave(fpath, palette.take(rcell_im, axis=0))
+        if outline_fpaths is not None:
+            outline_im = rcell_im * outline_mask(rcell_im)
+            with atomic_output(outline_fpaths[z-start_z]) as fpath:
+                imsave(fpath, palette.take(outline_im, axis=0))
+
+
+INTENSITY_FIELDS = [
+    ('mean_intensity', np.float64),
+    ('quartile_intensity', np.float64),
+    ('best_intensity', np.float64),
+    ('best_z', np.int64),
+]
+
+CELL_FIELDS = [
+    ('x', np.float64),
+    ('y', np.float64),
+    ('z', np.float64),
+    ('volume', np.int64),
+    ('zext', np.int64),
+    ('sum_seg_area', np.int64),
+]
+
+def results_dtype(channels=None):
+    """Return the dtype of the results table.
+
+    :param channels: names of the intensity channels; the intensity columns
+                     of the first channel are not prefixed, those of the
+                     other channels are prefixed with the channel name, e.g.
+                     yfp_mean_intensity. By default there is a single
+                     channel.
+    """
+    fields = list(INTENSITY_FIELDS)
+    for channel in list(channels or [])[1:]:
+        fields += [('{}_{}'.format(channel, name), dtype)
+                   for name, dtype in INTENSITY_FIELDS]
+    return np.dtype(fields + CELL_FIELDS)
+
+RESULTS_DTYPE = results_dtype()
+
+def channel_name(intensity_dir):
+    """Return the name of the channel in a directory or stack file."""
+    name = os.path.basename(os.path.normpath(intensity_dir))
+    if is_stack(name):
+        name = name[:-len(STACK_SUFFIX)]
+    return name
+
+def channel_names(intensity_dirs):
+    """Return the names of the channels in directories or stack files.
+
+    :raises: ValueError if two of the channels have the same name
+    """
+    names = [channel_name(d) for d in intensity_dirs]
+    if len(set(names)) != len(names):
+        raise ValueError('Intensity channels must have different names: {}'.format(
+            ', '.join(names)))
+    return names
+
+def measure_cells(rcells, idata, sum_segmentation_area, channels=None):
+    """Return structured array of the cell measurements.
+
+    :param idata: list of intensity images; a list of such lists, one per
+                  channel, if channels is given
+    :param channels: names of the intensity channels, see
+                     :func:`results_dtype`
+    :returns: structured array of dtype results_dtype(channels)
+    """
+    channel_data = [idata] if channels is None else idata
+    results = np.zeros(len(rcells), dtype=results_dtype(channels))
+    for i, rcell in enumerate(rcells):
+        x, y, z = rcell.centroid
+        intensities = ()
+        for measurements in rcell.measure_channels(channel_data):
+            intensities += measurements
+        results[i] = intensities + (x, y, z,
+                                    rcell.pixel_area,
+                                    rcell.z_extent,
+                                    sum_segmentation_area)
+    return results
+
+def write_results_csv(results, results_file):
+    """Write a structured array of results to a csv file."""
+    fmt = ['%d' if results.dtype[name].kind == 'i' else '%.12g'
+           for name in results.dtype.names]
+    with open(results_file, 'w') as fh:
+        fh.write(','.join(results.dtype.names) + '\n')
+        if len(results) > 0:
+            np.savetxt(fh, results, fmt=fmt, delimiter=',')
+
+def write_results_columnar(results, columnar_file):
+    """Write a structured array of results to a columnar npz file.
+
+    Each column is stored as a separate array; the column order is stored
+    in the 'columns' array. See :func:`load_results_columnar`.
+    """
+    columns = dict((name, results[name]) for name in results.dtype.names)
+    with open(columnar_file, 'wb') as fh:
+        np.savez(fh, columns=np.array(results.dtype.names), **columns)
+
+def load_results_columnar(columnar_file):
+    """Return structured array of results from a columnar npz file."""
+    with closing(np.load(columnar_file)) as data:
+        names = [str(name) for name in data['columns']]
+        columns = [data[name] for name in names]
+    dtype = np.dtype([(name, column.dtype) for name, column in zip(names, columns)])
+    results = np.zeros(len(columns[0]), dtype=dtype)
+    for name, column in zip(names, columns):
+        results[name] = column
+    return results
+
+def load_intensity_data(intensity_dir, num_threads=DECODE_THREADS):
+    """Return list of intensity images from a directory or stack file."""
+    return load_images(intensity_dir, num_threads)
+
+def load_channels(measure_dir, num_threads=DECODE_THREADS):
+    """Return (intensity data, channel names) of the intensity channels.
+
+    :param measure_dir: directory or stack file of a single channel, or a
+                        list of those of several channels
+    :returns: the intensity images and None for a single channel; for
+              several channels a list of the intensity images of each
+              channel and the channel names, see :func:`measure_cells`
+    """
+    if isinstance(measure_dir, basestring):
+        return load_intensity_data(measure_dir, num_threads), None
+    channels = channel_names(measure_dir)
+    idata = [load_intensity_data(d, num_threads) for d in measure_dir]
+    return idata, channels
 
 def reconstruct_and_measure(seg_dir, measure_dir,
                             out_dir, results_file,
-                            start_z, end_z):
+                            start_z, end_z, num_threads=DECODE_THREADS,
+                            reconstruction_file=None, columnar_file=None,
+                            outline_dir=None, engine='pairwise',
+                            atomic_output=None):
+    """Reconstruct the cells and measure their intensities.
+
+    measure_dir is the directory or stack file of the intensity images, or a
+    list of those of several channels which are all measured against the
+    same reconstruction, see :func:`load_channels`.
+
+    The reconstruction engine is 'pairwise' or 'volume', see
+    :func:`reconstructor.build_reconstruction`.
+
+    If reconstruction_file is given the reconstruction is also saved to it,
+    see :func:`measure_reconstruction`. If columnar_file is given the
+    results are also written to it, see :func:`write_results_columnar`. If
+    outline_dir is given the outlines of the cells are written to it along
+    with the masks. The masks and outlines are written through
+    atomic_output if given, see :func:`generate_reconstruction_mask`.
+    """
     logger.info('Segmentation dir: {}'.format(seg_dir))
     logger.info('Measurement dir: {}'.format(measure_dir))
     logger.info('Output dir: {}'.format(out_dir))
     logger.info('Results file: {}'.format(results_file))
-    use_plugin('freeimage')
 
-    smaps = load_segmentation_maps(seg_dir)
-    idata = load_intensity_data(measure_dir)
-
-    xdim, ydim = idata[0].shape
+    smaps = load_segmentation_maps(seg_dir, num_threads)
+    idata, channels = load_channels(measure_dir, num_threads)
 
     if start_z is None:
         start_z = 0
@@ -96,58 +271,104 @@ def reconstruct_and_measure(seg_dir, measure_dir,
     logger.info('Start z: {:d}'.format(start_z))
     logger.info('End z: {:d}'.format(end_z))
 
-    r = Reconstruction(smaps, start=start_z) 
+    r = build_reconstruction(smaps, start_z, end_z, engine)
     logger.debug('Reconstruction instance: {}'.format(r))
 
-    for z in range(start_z, end_z):
-        r.extend(z)
-
+    if reconstruction_file is not None:
+        r.save(reconstruction_file)
+
+    label_images = [smap.im_array for smap in smaps]
+    measure(r, seg_dir, label_images, idata, out_dir, results_file,
+            start_z, end_z, total_segmented_area(smaps),
+            columnar_file, outline_dir, channels, atomic_output)
+
+def measure_reconstruction(reconstruction_file, seg_dir, measure_dir,
+                           out_dir, results_file, num_threads=DECODE_THREADS,
+                           columnar_file=None, outline_dir=None,
+                           atomic_output=None):
+    """Measure the intensities of the cells of a saved reconstruction."""
+    logger.info('Reconstruction file: {}'.format(reconstruction_file))
+    r = Reconstruction.load(reconstruction_file)
+    idata, channels = load_channels(measure_dir, num_threads)
+    label_images = load_images(seg_dir, num_threads)
+    smaps = [SegmentationMap.from_array(im) for im in label_images]
+    measure(r, seg_dir, label_images, idata, out_dir, results_file,
+            r.start, r.end, total_segmented_area(smaps),
+            columnar_file, outline_dir, channels, atomic_output)
+
+def measure(r, seg_dir, label_images, idata, out_dir, results_file,
+            start_z, end_z, sum_segmentation_area,
+            columnar_file=None, outline_dir=None, channels=None,
+            atomic_output=None):
+    """Write the reconstruction masks and the measurements of the cells.
+
+    :param sum_segmentation_area: total number of segmented pixels in the
+                                  stack, see :func:`total_segmented_area`
+    :param channels: names of the intensity channels, see
+                     :func:`measure_cells`
+    :param atomic_output: see :func:`generate_reconstruction_mask`
+    """
     rcells = r.cells_larger_then(3)
 
     # Write the mask images
     mask_fpaths = get_mask_output_fpaths(seg_dir, out_dir, start_z, end_z)
-    generate_reconstruction_mask(mask_fpaths, xdim, ydim, rcells, start_z, end_z)
-
-    # Calculate total area
-    sum_segmentation_area = sum_segmentation_dir(seg_dir)
-    
-    with open(results_file, "w") as f:
-        f.write('mean_intensity,quartile_intensity,best_intensity,best_z,x,y,z,volume,zext,sum_seg_area\n')
-        for rcell in rcells:
-            x, y, z = rcell.centroid
-            mean_intensity = rcell.measure_mean_intensity(idata)
-            quartile_intensity = rcell.measure_quartile_intensity(idata)
-            best_intensity, best_z = rcell.measure_best_slice(idata)
-            volume = rcell.pixel_area
-            zext = rcell.z_extent
-
-            f.write("{},{},{},{},{},{},{},{},{},{}\n".format(
-                mean_intensity,
-                quartile_intensity,
-                best_intensity,
-                best_z,
-                x, y, z,
-                volume,
-                zext,
-                sum_segmentation_area))
+    outline_fpaths = None
+    if outline_dir is not None:
+        if not os.path.isdir(outline_dir):
+            os.mkdir(outline_dir)
+        outline_fpaths = get_mask_output_fpaths(seg_dir, outline_dir,
+                                                start_z, end_z)
+    generate_reconstruction_mask(mask_fpaths, label_images, rcells,
+                                 start_z, end_z, outline_fpaths,
+                                 atomic_output)
+
+    results = measure_cells(rcells, idata, sum_segmentation_area, channels)
+    write_results_csv(results, results_file)
+    if columnar_file is not None:
+        write_results_columnar(results, columnar_file)
 
 def main():
     
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('seg_dir', help="Path to directory containing segmented images")
-    parser.add_argument('measure_dir', help="Path to directory containing intensity images")
+    parser.add_argument('measure_dir', nargs='+',
+                        help="Paths to directories containing intensity images, one per channel")
     parser.add_argument('out_dir', help="Path to output directory")
     parser.add_argument('results_file', help="Filename to which results should be output")
     parser.add_argument('--z_start', help="First z-stack",
                         default=None, type=int)
     parser.add_argument('--z_end', help="Last z-stack",
                         default=None, type=int)
+    parser.add_argument('--threads', help="Number of image decoding threads",
+                        default=DECODE_THREADS, type=int)
+    parser.add_argument('--save_reconstruction', default=None,
+                        help="File to which the reconstruction should be saved")
+    parser.add_argument('--load_reconstruction', default=None,
+                        help="Measure using a previously saved reconstruction")
+    parser.add_argument('--columnar_file', default=None,
+                        help="Also write the results to this npz file")
+    parser.add_argument('--outline_dir', default=None,
+                        help="Also write the cell outlines to this directory")
+    parser.add_argument('--engine', default='pairwise', choices=ENGINES,
+                        help="Reconstruction engine")
 
     args = parser.parse_args()
+    if len(args.measure_dir) == 1:
+        args.measure_dir = args.measure_dir[0]
+
+    if args.load_reconstruction is not None:
+        measure_reconstruction(args.load_reconstruction, args.seg_dir,
+                               args.measure_dir, args.out_dir,
+                               args.results_file, args.threads,
+                               args.columnar_file, args.outline_dir)
+        return
 
     recons = reconstruct_and_measure(args.seg_dir, args.measure_dir,
                                      args.out_dir, args.results_file,
-                                     args.z_start, args.z_end)
+                                     args.z_start, args.z_end, args.threads,
+                                     args.save_reconstruction,
+                                     args.columnar_file, args.outline_dir,
+                                     args.engine)
 
     
 
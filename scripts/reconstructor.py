@@ -1,10 +1,15 @@
 import re
 import os
+from contextlib import closing
 
 import numpy as np
-from skimage.io import use_plugin, imread
 
 from coords2d import Coords2D
+from stack_io import (is_stack, read_stack, iread_images, slice_names,
+                      DECODE_THREADS)
+from label_store import is_label_file, LabelImage
+from image_io import imread
+from tiling import TILE_SIZE, iter_tiles
 
 import logging
 logger = logging.getLogger('__main__.{}'.format(__name__))
@@ -15,6 +20,25 @@ def sorted_nicely( l ):
     alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ]
     return sorted(l, key = alphanum_key)
 
+def intensity_statistics(slice_arrays):
+    """Return the intensity statistics of a cell from those of its slices.
+
+    :param slice_arrays: list of arrays of the pixel intensities of each
+                         slice of the cell
+    :returns: (mean, quartile, best, best_z) tuple; quartile is the mean of
+              the upper half of the pixels taken in slice order, best the
+              largest slice mean and best_z the position of that slice in
+              slice_arrays
+    """
+    total_intensity = sum(sa.sum() for sa in slice_arrays)
+    as_single_array = np.concatenate(slice_arrays)
+    n_frac = len(as_single_array) / 2
+    slice_means = [np.mean(sa) for sa in slice_arrays]
+    return (float(total_intensity) / len(as_single_array),
+            np.mean(as_single_array[n_frac:]),
+            max(slice_means),
+            np.array(slice_means).argmax())
+
 class ReconstructedCell(object):
     """Pseudo 3D cell from contiguous z-stacks."""
 
@@ -47,27 +71,53 @@ class ReconstructedCell(object):
             total_intensity += z_correction * sum(idata[sID][cellslice.coord_list])
         return total_intensity
 
+    def slice_intensities(self, idata):
+        """Return list of the intensities of the pixels of each slice."""
+        return [idata[sID][cellslice.coord_list]
+                for sID, cellslice in self.slice_dict.items()]
+
     def measure_mean_intensity(self, idata):
         """Return the mean intensity of the reconstructed cell."""
-        return float(self.measure_total_intensity(idata)) / self.pixel_area
+        return intensity_statistics(self.slice_intensities(idata))[0]
 
     def measure_quartile_intensity(self, idata):
         """Return the quartile intensity of the reconstructed cell."""
-        all_measurements = [idata[sID][cellslice.coord_list]
-                            for sID, cellslice in self.slice_dict.items()]
-        as_single_array = np.concatenate(all_measurements)
-        n_frac = len(as_single_array) / 2
-        return np.mean(as_single_array[n_frac:])
+        return intensity_statistics(self.slice_intensities(idata))[1]
 
     def measure_best_slice(self, idata):
         """Return the intensity from the most intense slice."""
-        slice_arrays = [idata[sID][cellslice.coord_list]
-                        for sID, cellslice in self.slice_dict.items()]
-        slice_means = [np.mean(sa) for sa in slice_arrays]
-        best_slice = max(slice_means)
-        best_z = np.array(slice_means).argmax()
-        return best_slice, best_z
-        
+        return intensity_statistics(self.slice_intensities(idata))[2:]
+
+    def measure_channels(self, channels):
+        """Return list of the intensities of the cell in several channels.
+
+        The pixel positions of each slice are computed once and used to read
+        the slice in every channel.
+
+        :param channels: list of intensity data, e.g. one list of images per
+                         channel
+        :returns: list of (mean, quartile, best, best_z) tuples, one per
+                  channel, as given by :meth:`measure_mean_intensity`,
+                  :meth:`measure_quartile_intensity` and
+                  :meth:`measure_best_slice`
+        :raises: ValueError if the images of a slice differ in shape
+                 between the channels
+        """
+        slice_arrays = [[] for _ in channels]
+        for sID, cellslice in self.slice_dict.items():
+            images = [np.asarray(idata[sID]) for idata in channels]
+            shape = images[0].shape
+            for im in images[1:]:
+                if im.shape != shape:
+                    raise ValueError(
+                        'Slice {} has shape {} in one channel and {} in '
+                        'another.'.format(sID, shape, im.shape))
+            flat = np.ravel_multi_index(cellslice.coord_list, shape)
+            for arrays, im in zip(slice_arrays, images):
+                arrays.append(im.take(flat))
+
+        return [intensity_statistics(arrays) for arrays in slice_arrays]
+
     def __repr__(self):
         return "<ReconstructedCell: {:d}>".format(self.ID)
 #       return "<ReconstructedCell: %s>" % self.slice_dict.__repr__()
@@ -116,14 +166,68 @@ class CellSlice(object):
         return "<CellSlice, ID %d>" % self.ID
 
 class SegmentationMap(object):
-    """Container for the pseudo 3D reconstructed cells."""
+    """Container for the pseudo 3D reconstructed cells.
+
+    Label files are decoded lazily; looking up the cell id at a position
+    only decodes the tile containing it.
+    """
 
     def __init__(self, image_file):
         logger.debug('Initialising SegmentationMap')
-        use_plugin('freeimage')
-        self.im_array = imread(image_file)
+        self.label_image = None
+        self.internal_im_array = None
+        if is_label_file(image_file):
+            self.label_image = LabelImage(image_file)
+        else:
+            self.internal_im_array = imread(image_file)
         self.internal_cc = None
         self.internal_coords = {}
+        self.internal_area = None
+        self.internal_index = None
+
+    @classmethod
+    def from_array(cls, im_array):
+        """Return a segmentation map of an image array."""
+        smap = cls.__new__(cls)
+        smap.label_image = None
+        smap.internal_im_array = im_array
+        smap.internal_cc = None
+        smap.internal_coords = {}
+        smap.internal_area = None
+        smap.internal_index = None
+        return smap
+
+    @property
+    def im_array(self):
+        """Return the label image array."""
+        if self.internal_im_array is None:
+            self.internal_im_array = self.label_image.read()
+        return self.internal_im_array
+
+    @property
+    def segmented_area(self):
+        """Return the number of pixels covered by cells."""
+        if self.internal_area is None:
+            if self.internal_im_array is None:
+                # Label files store the count; no need to decode them.
+                self.internal_area = self.label_image.nonzero
+            else:
+                self.internal_area = int(np.count_nonzero(self.internal_im_array))
+        return self.internal_area
+
+    def _id_at(self, position):
+        """Return the label at position (x, y), decoding as little as possible."""
+        if self.internal_im_array is None:
+            return self.label_image.value_at(position)
+        x, y = position
+        return self.internal_im_array[x, y]
+
+    @property
+    def cell_index(self):
+        """Return the spatial index of the cells, see :class:`CellIndex`."""
+        if self.internal_index is None:
+            self.internal_index = CellIndex(self.im_array)
+        return self.internal_index
 
     @property
     def cells(self):
@@ -136,22 +240,18 @@ class SegmentationMap(object):
 
     def cell_id_at(self, position):
         """Return the cell id at position (x, y)."""
-        x, y = position
-
-        ID = self.im_array[x, y]
+        ID = self._id_at(position)
         if ID == 0:
             return None
         return ID
 
     def cell_at(self, position):
         """Return the cell at position (x, y)."""
-        x, y = position
-
-        ID = self.im_array[x, y]
+        ID = self._id_at(position)
         if ID == 0:
             return None
 
-        return self.cells[self.im_array[x, y]]
+        return self.cells[ID]
 
     @property
     def all_ids(self):
@@ -168,14 +268,107 @@ class SegmentationMap(object):
             self.internal_coords[cID] = np.where(self.im_array == cID)
         return self.internal_coords[cID]
 
+class CellIndex(object):
+    """Spatial index over the centroids and bounding boxes of the cells in
+    a label image.
+
+    The centroids are held in a KD-tree, so the queries take logarithmic
+    rather than linear time in the number of cells. All queries take an
+    array of points or boxes and answer them in one call.
+    """
+
+    def __init__(self, im_array):
+        from scipy.ndimage import find_objects
+        from scipy.spatial import cKDTree
+        labels = np.asarray(im_array).ravel()
+        xs, ys = np.indices(im_array.shape)
+        areas = np.bincount(labels)
+        areas[0] = 0
+        self.ids = np.flatnonzero(areas)
+        self.areas = areas[self.ids]
+        self.centroids = np.column_stack([
+            np.bincount(labels, weights=xs.ravel())[self.ids],
+            np.bincount(labels, weights=ys.ravel())[self.ids]]) \
+            / areas[self.ids][:, np.newaxis]
+        objects = find_objects(im_array)
+        self.bboxes = np.array([[objects[cid-1][0].start, objects[cid-1][0].stop,
+                                 objects[cid-1][1].start, objects[cid-1][1].stop]
+                                for cid in self.ids], dtype=np.int64).reshape(-1, 4)
+        if len(self.ids):
+            self.tree = cKDTree(self.centroids)
+            self.max_extent = int(max((self.bboxes[:,1] - self.bboxes[:,0]).max(),
+                                      (self.bboxes[:,3] - self.bboxes[:,2]).max()))
+        else:
+            self.tree = None
+            self.max_extent = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nearest(self, points, max_distance=np.inf):
+        """Return the ids of and distances to the cells nearest to points.
+
+        :param points: array of (x, y) positions
+        :param max_distance: cells further away are not returned
+        :returns: tuple of arrays (ids, distances); the id is 0 and the
+                  distance inf where there is no cell within max_distance
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        ids = np.zeros(len(points), dtype=self.ids.dtype)
+        if self.tree is None:
+            return ids, np.full(len(points), np.inf)
+        distances, indices = self.tree.query(points,
+                                             distance_upper_bound=max_distance)
+        found = indices < len(self.ids)
+        ids[found] = self.ids[indices[found]]
+        return ids, distances
+
+    def within_radius(self, points, radius):
+        """Return list of arrays of the ids of the cells whose centroids are
+        within radius of each point."""
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        if self.tree is None:
+            return [self.ids[:0] for _ in points]
+        return [self.ids[sorted(indices)]
+                for indices in self.tree.query_ball_point(points, radius)]
+
+    def in_bounding_box(self, boxes):
+        """Return list of arrays of the ids of the cells whose bounding
+        boxes overlap each box.
+
+        :param boxes: array of (x0, x1, y0, y1) boxes, end exclusive
+        """
+        boxes = np.atleast_2d(np.asarray(boxes, dtype=float))
+        if self.tree is None:
+            return [self.ids[:0] for _ in boxes]
+        # A cell overlapping a box has its centroid within its own extent
+        # of the box, which narrows the candidates down to a tree query.
+        centres = np.column_stack([(boxes[:,0] + boxes[:,1]) / 2.,
+                                   (boxes[:,2] + boxes[:,3]) / 2.])
+        radii = np.maximum(boxes[:,1] - boxes[:,0], boxes[:,3] - boxes[:,2]) / 2. \
+            + self.max_extent
+        results = []
+        for (x0, x1, y0, y1), centre, r in zip(boxes, centres, radii):
+            candidates = np.array(sorted(self.tree.query_ball_point(centre, r, p=np.inf)),
+                                  dtype=np.intp)
+            b = self.bboxes[candidates]
+            overlap = (b[:,0] < x1) & (b[:,1] > x0) & (b[:,2] < y1) & (b[:,3] > y0)
+            results.append(self.ids[candidates[overlap]])
+        return results
+
 class Reconstruction(object):
     """Pseudo 3D reconstruction."""
 
+    # Name of the engine building the reconstruction, see ENGINES.
+    engine = 'pairwise'
+
     def __init__(self, smaps, start=0):
         logger.debug('Initialising Reconstruction.')
         self.smaps = smaps
         self.rcells = []
         self.lut = {}
+        self.start = start
+        self.end = start
         z = start
         for ID in smaps[z].all_ids:
             logger.debug('Loop id: {}'.format(ID))
@@ -188,6 +381,7 @@ class Reconstruction(object):
         """Add another z-stack to the reconstruction."""
         z = level
         matches = find_slice_links(self.smaps[z], self.smaps[z+1])
+        self.end = max(self.end, z+1)
 
         for f, t in matches.iteritems():
             try:
@@ -218,30 +412,292 @@ class Reconstruction(object):
             f.write('\n'.join([rcell.simple_string_rep()
                                for rcell in self.rcells]))
 
+    def save(self, filename):
+        """Save the reconstruction to a binary file.
+
+        Stores the slice memberships of the reconstructed cells along with
+        the pixel coordinates of every cell slice, so that the
+        reconstruction can be loaded without linking the slices again. The
+        engine and z range it was built with are stored too, see
+        :func:`saved_reconstruction_settings`. See
+        :func:`Reconstruction.load`.
+        """
+        members = []
+        cellslices = []
+        for rcell in self.rcells:
+            for z in sorted(rcell.slice_dict.keys()):
+                cellslice = rcell.slice_dict[z]
+                members.append((rcell.ID, z, cellslice.ID))
+                cellslices.append(cellslice)
+
+        offsets = np.zeros(len(cellslices)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([cs.pixel_area for cs in cellslices])
+        x_coords = np.zeros(0, dtype=np.int32)
+        y_coords = np.zeros(0, dtype=np.int32)
+        if cellslices:
+            x_coords = np.concatenate([cs.x_coords for cs in cellslices])
+            y_coords = np.concatenate([cs.y_coords for cs in cellslices])
+
+        # Write to a file handle; np.savez would add a suffix to the name.
+        with open(filename, 'wb') as fh:
+            np.savez(fh,
+                     num_rcells=np.array(len(self.rcells)),
+                     engine=np.array(self.engine),
+                     z_range=np.array([self.start, self.end]),
+                     members=np.array(members, dtype=np.int32).reshape(-1, 3),
+                     offsets=offsets,
+                     x_coords=x_coords.astype(np.int32),
+                     y_coords=y_coords.astype(np.int32))
+
+    @classmethod
+    def load(cls, filename):
+        """Return a reconstruction loaded from a binary file.
+
+        The cell slices of the loaded reconstruction are views into the
+        stored coordinates. It has no segmentation maps, so it cannot be
+        extended.
+        """
+        with closing(np.load(filename)) as data:
+            engine = Reconstruction.engine
+            if 'engine' in data.files:
+                engine = str(data['engine'])
+            z_range = data['z_range']
+            num_rcells = int(data['num_rcells'])
+            offsets = data['offsets']
+            x_coords = data['x_coords']
+            y_coords = data['y_coords']
+            members = data['members'].tolist()
+        r = cls.__new__(cls)
+        r.smaps = None
+        r.engine = engine
+        r.start, r.end = [int(z) for z in z_range]
+        r.rcells = [ReconstructedCell(rcell_id, {})
+                    for rcell_id in range(num_rcells)]
+        r.lut = {}
+        for i, (rcell_id, z, cid) in enumerate(members):
+            begin, end = offsets[i], offsets[i+1]
+            cellslice = CellSlice(cid, (x_coords[begin:end],
+                                        y_coords[begin:end]))
+            rcell = r.rcells[rcell_id]
+            rcell.add_slice(z, cellslice)
+            r.lut[(z, cid)] = rcell
+        return r
+
 def cell_dict_from_image_array(i_array):
-    """Return dictionary of cell slices from an array of images."""
-    cd = {cid: CellSlice(cid, np.where(i_array == cid))
-          for cid in np.unique(i_array)}
-    del(cd[0])
-    return cd
-
-def load_segmentation_maps(slice_dir):
-    """Return list of segmentation maps from a directory of segmentations."""
-    image_files = os.listdir(slice_dir)
-    image_files = sorted_nicely(image_files)
-    smaps = [SegmentationMap(os.path.join(slice_dir, im_file))
-             for im_file in image_files]
+    """Return dictionary of cell slices from an array of images.
+
+    The pixels are grouped by label with one stable sort rather than one
+    comparison of the whole image per label; the coordinates of each cell
+    are in the same (row-major) order as those of np.where.
+    """
+    labels = np.asarray(i_array).ravel()
+    order = np.argsort(labels, kind='mergesort')
+    cids, starts = np.unique(labels[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    xs, ys = np.unravel_index(order, i_array.shape)
+    return {cid: CellSlice(cid, (xs[begin:end], ys[begin:end]))
+            for cid, begin, end in zip(cids, starts, ends)
+            if cid != 0}
+
+# Minimum overlap (intersection over union) of two cell slices in
+# consecutive z-slices for the volume engine to consider them one cell.
+MIN_IOU = 0.25
+
+def slice_overlaps(labels1, labels2, tile_size=TILE_SIZE):
+    """Return arrays (ids1, ids2, iou) of the overlapping cells of two
+    label images.
+
+    Computed in one pass over the pixels by counting the pairs of labels.
+    The pairs are counted tile by tile, so the temporary arrays only cover
+    one tile; the label images can be memory mapped.
+    """
+    base = int(max(labels1.max(), labels2.max())) + 1
+    area1 = np.zeros(base, dtype=np.int64)
+    area2 = np.zeros(base, dtype=np.int64)
+    tile_pairs = []
+    tile_counts = []
+    for tile in iter_tiles(labels1.shape, tile_size):
+        tile1 = np.asarray(labels1[tile.core], dtype=np.int64).ravel()
+        tile2 = np.asarray(labels2[tile.core], dtype=np.int64).ravel()
+        area1 += np.bincount(tile1, minlength=base)
+        area2 += np.bincount(tile2, minlength=base)
+        both = (tile1 != 0) & (tile2 != 0)
+        pairs, counts = np.unique(tile1[both] * base + tile2[both],
+                                  return_counts=True)
+        tile_pairs.append(pairs)
+        tile_counts.append(counts)
+    pairs, inverse = np.unique(np.concatenate(tile_pairs), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(tile_counts),
+                         minlength=len(pairs)).astype(np.int64)
+    ids1, ids2 = pairs // base, pairs % base
+    iou = counts.astype(float) / (area1[ids1] + area2[ids2] - counts)
+    return ids1, ids2, iou
+
+def mutual_best_links(ids1, ids2, iou, min_iou=MIN_IOU):
+    """Return the (ids1, ids2) pairs that are each other's best overlap.
+
+    Keeping only mutual best matches links every cell slice to at most one
+    slice in the next z-slice.
+    """
+    keep = iou >= min_iou
+    ids1, ids2, iou = ids1[keep], ids2[keep], iou[keep]
+    # Sort by decreasing overlap; the first occurrence of an id is its best.
+    order = np.argsort(-iou, kind='mergesort')
+    ids1, ids2 = ids1[order], ids2[order]
+    best1 = np.zeros(len(ids1), dtype=bool)
+    best1[np.unique(ids1, return_index=True)[1]] = True
+    best2 = np.zeros(len(ids2), dtype=bool)
+    best2[np.unique(ids2, return_index=True)[1]] = True
+    mutual = best1 & best2
+    return ids1[mutual], ids2[mutual]
+
+class VolumeReconstruction(Reconstruction):
+    """3D reconstruction from the overlaps of the cells in a label volume.
+
+    Cell slices in consecutive z-slices are linked when they are each
+    other's best overlap and their intersection over union is at least
+    min_iou. The reconstructed cells are the connected components of the
+    links, i.e. the 3D labels of the volume, which are found in one pass
+    rather than by extending the reconstruction slice by slice.
+
+    The reconstructed cells have the same interface as those of
+    :class:`Reconstruction`; their IDs are ordered by the first z-slice
+    they occur in and then by cell id.
+    """
+
+    engine = 'volume'
+
+    def __init__(self, smaps, start=0, end=None, min_iou=MIN_IOU):
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        logger.debug('Initialising VolumeReconstruction.')
+        if end is None:
+            end = len(smaps) - 1
+        self.smaps = smaps
+        self.start = start
+        self.end = end
+
+        # Number the cell slices of the volume in (z, id) order.
+        zs = range(start, end+1)
+        slice_ids = [np.array(sorted(smaps[z].cells.keys()), dtype=np.int64)
+                     for z in zs]
+        offsets = np.cumsum([0] + [len(ids) for ids in slice_ids])
+
+        rows = []
+        cols = []
+        for i, z in enumerate(zs[:-1]):
+            ids1, ids2 = mutual_best_links(
+                *slice_overlaps(smaps[z].im_array, smaps[z+1].im_array),
+                min_iou=min_iou)
+            rows.append(offsets[i] + np.searchsorted(slice_ids[i], ids1))
+            cols.append(offsets[i+1] + np.searchsorted(slice_ids[i+1], ids2))
+        num_slices = int(offsets[-1])
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+        graph = coo_matrix((np.ones(len(rows)), (rows, cols)),
+                           shape=(num_slices, num_slices))
+        _, components = connected_components(graph, directed=False)
+
+        # Number the components in order of their first cell slice.
+        _, first = np.unique(components, return_index=True)
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first)] = np.arange(len(first))
+        rcell_ids = rank[components]
+
+        self.rcells = [ReconstructedCell(rcell_id, {})
+                       for rcell_id in range(len(first))]
+        self.lut = {}
+        for i, z in enumerate(zs):
+            cells = smaps[z].cells
+            for cid, rcell_id in zip(slice_ids[i].tolist(),
+                                     rcell_ids[offsets[i]:offsets[i+1]].tolist()):
+                rcell = self.rcells[rcell_id]
+                rcell.add_slice(z, cells[cid])
+                self.lut[(z, cid)] = rcell
+
+    def extend(self, level):
+        """The volume is reconstructed at once; it cannot be extended."""
+        raise NotImplementedError('A volume reconstruction cannot be extended.')
+
+# Reconstruction engines selectable by name.
+ENGINES = ('pairwise', 'volume')
+
+def build_reconstruction(smaps, start_z, end_z, engine='pairwise'):
+    """Return the reconstruction of the slices start_z to end_z.
+
+    :param engine: 'pairwise' links the slices one pair at a time with the
+                   centroid heuristic of :class:`Reconstruction`; 'volume'
+                   uses :class:`VolumeReconstruction`
+    """
+    if engine == 'volume':
+        return VolumeReconstruction(smaps, start=start_z, end=end_z)
+    if engine != 'pairwise':
+        raise ValueError('Unknown reconstruction engine: {}'.format(engine))
+    r = Reconstruction(smaps, start=start_z)
+    for z in range(start_z, end_z):
+        r.extend(z)
+    return r
+
+def saved_reconstruction_settings(filename):
+    """Return (engine, start_z, end_z) of a saved reconstruction.
+
+    Reconstructions saved before the engine was stored were built by the
+    pairwise engine.
+    """
+    with closing(np.load(filename)) as data:
+        engine = Reconstruction.engine
+        if 'engine' in data.files:
+            engine = str(data['engine'])
+        start_z, end_z = [int(z) for z in data['z_range']]
+    return engine, start_z, end_z
+
+def load_segmentation_maps(slice_dir, num_threads=DECODE_THREADS):
+    """Return list of segmentation maps from a directory of segmentations.
+
+    The segmentations are decoded in num_threads threads. They can also be
+    given as a stack file.
+    """
+    if is_stack(slice_dir):
+        return [SegmentationMap.from_array(im_array)
+                for im_array in read_stack(slice_dir)]
+    image_files = slice_names(slice_dir)
+    fpaths = [os.path.join(slice_dir, im_file) for im_file in image_files]
+    smaps = list(iread_images(fpaths, reader=SegmentationMap,
+                              num_threads=num_threads))
     return smaps
 
+def total_segmented_area(smaps):
+    """Return the number of pixels covered by cells in all the maps."""
+    return sum(smap.segmented_area for smap in smaps)
+
 def find_slice_links(slice_map1, slice_map2):
-    """Return dictionary of matched cells between two slice maps."""
-    matches = {}
-    for cell_slice in slice_map1.cells.values():
-        c = cell_slice.centroid
-        candidate_slice = slice_map2.cell_at(c)
-        if slice_from_same_cell(cell_slice, candidate_slice):
-            matches[cell_slice.ID] = candidate_slice.ID
-    return matches
+    """Return dictionary of matched cells between two slice maps.
+
+    Each cell slice is matched to the cell slice at its centroid in the next
+    map if they are from the same cell, see :func:`slice_from_same_cell`.
+    The centroids and areas come from the cell indexes of the maps, so all
+    the cells are looked up and compared in one go.
+    """
+    index1 = slice_map1.cell_index
+    index2 = slice_map2.cell_index
+    if not len(index1) or not len(index2):
+        return {}
+
+    # Whole pixel centroids, as those of CellSlice.
+    centroids1 = np.floor(index1.centroids).astype(np.intp)
+    centroids2 = np.floor(index2.centroids).astype(np.intp)
+    candidates = slice_map2.im_array[centroids1[:,0], centroids1[:,1]]
+    found = candidates != 0
+    rows = np.searchsorted(index2.ids, candidates[found])
+
+    area_ratio = index1.areas[found].astype(float) / index2.areas[rows]
+    dist = np.hypot(*(centroids1[found] - centroids2[rows]).T)
+    same = (0.5 < area_ratio) & (area_ratio < 1.5) & (dist < 20)
+
+    links = dict(zip(index1.ids[found][same], candidates[found][same]))
+    # Insert in the order of the cells of the first map; Reconstruction
+    # numbers new reconstructed cells in the order of the matches.
+    return {cid: links[cid] for cid in slice_map1.cells if cid in links}
 
 def slice_from_same_cell(slice1, slice2):
     """Whether or not two cell slices are from the same cell."""
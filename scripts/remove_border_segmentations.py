@@ -1,11 +1,12 @@
 import os
 import argparse
 
-import cv2
+from image_io import imread, imsave
+from label_store import is_label_file, write_labels
 
 def remove_border_segmentations(input_file, output_file):
     """Remove segments that touch the image border."""
-    im = cv2.imread(input_file, -1)
+    im = imread(input_file, backend='cv2')
     xdim, ydim = im.shape
     print('xdim {}; ydim {}'.format(xdim, ydim))
 
@@ -21,7 +22,12 @@ def remove_border_segmentations(input_file, output_file):
         mask = ( im != bs_id )
         im = im * mask
 
-    cv2.imwrite(output_file, im)
+    if is_label_file(output_file):
+        # The label file records the extension of the image it replaces.
+        write_labels(output_file, im,
+                     image_ext=os.path.splitext(input_file)[1])
+    else:
+        imsave(output_file, im, backend='cv2')
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
@@ -7,10 +7,9 @@ import tempfile
 import subprocess
 
 import numpy as np
-from PIL import Image
-from scipy.ndimage import measurements
 
-import cv2
+from image_io import imread, imread_mapped, imsave
+
 import logging
 
 logger = logging.getLogger('__main__.{}'.format(__name__))
@@ -19,10 +18,15 @@ logger = logging.getLogger('__main__.{}'.format(__name__))
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
-def segment_image(input_file, fiji_exe, fiji_script):
+def segment_image(input_file, fiji_exe, fiji_script, mapped=False):
     """Return a segmented numpy image.
     
-    Runs fiji in headless mode."""
+    Runs fiji in headless mode.
+
+    :param mapped: memory map the 8-bit image written by fiji rather than
+                   reading it, if it is uncompressed
+    """
+    from PIL import Image
 
     with tempfile.NamedTemporaryFile(suffix='.tiff', delete=False) as tmp_fh:
         output_file = tmp_fh.name
@@ -35,12 +39,27 @@ def segment_image(input_file, fiji_exe, fiji_script):
     if err:
         logger.warning(err)
 
-    numpy_im = np.array(Image.open(output_file).convert('L'))
+    numpy_im = None
+    if mapped:
+        # The mapping outlives the unlinked file.
+        numpy_im = imread_mapped(output_file)
+        if numpy_im.ndim != 2 or numpy_im.dtype != np.uint8:
+            numpy_im = None
+    if numpy_im is None:
+        numpy_im = np.array(Image.open(output_file).convert('L'))
     os.unlink(output_file)
     return numpy_im 
 
-def color_objects(numpy_im, min_num_pixels):
-    """Return a segmented numpy image with each object colored differently."""
+def color_objects(numpy_im, min_num_pixels, tile_size=None, mapper=map):
+    """Return a segmented numpy image with each object colored differently.
+
+    If tile_size is given the objects are labelled tile by tile and stitched
+    across the tile seams, see :func:`tiling.label_tiles`; the result is the
+    same. The tiles are processed with mapper, see :func:`tiling.tile_map`.
+    """
+    from scipy.ndimage import measurements
+    if tile_size is not None:
+        return _color_objects_tiled(numpy_im, min_num_pixels, tile_size, mapper)
     numpy_im = 1*(numpy_im<128)  # make sure the image is binary
     labels, num_objects = measurements.label(numpy_im)
     logger.info('Number of objects: {}'.format(num_objects))
@@ -62,17 +81,49 @@ def color_objects(numpy_im, min_num_pixels):
 
     return labels
 
+def _color_objects_tiled(numpy_im, min_num_pixels, tile_size, mapper=map):
+    """Return the colored objects of an image labelled tile by tile."""
+    from tiling import map_tiles, label_tiles
+    binary = map_tiles(lambda tile: tile < 128, numpy_im, tile_size,
+                       mapper=mapper)
+    labels, num_objects = label_tiles(binary, tile_size, mapper=mapper)
+    logger.info('Number of objects: {}'.format(num_objects))
+
+    # Filter out objects that do not have enough pixels.
+    sizes = np.bincount(labels.ravel(), minlength=num_objects+1)
+    too_small = sizes < min_num_pixels
+    too_small[0] = False
+    labels[too_small[labels]] = 0
+    logger.info('Number of objects after size filter: {}'.format(
+                                num_objects - np.count_nonzero(too_small)))
+    logger.info('Max value of an object after size filter: {}'.format(
+                                np.max(labels)))
+
+    return labels
+
 def save_image(im, output_file):
     """Save the image in 16-bit."""
     im = np.array(im, dtype=np.uint16)
-    cv2.imwrite(output_file, im)
-
-def full_segment_image(input_file, output_file, fiji_exe, fiji_script, min_num_pixels):
-    """Run the segmentation and write out the image."""
-    numpy_im = segment_image(input_file, fiji_exe, fiji_script)
-    colored_im = color_objects(numpy_im, min_num_pixels=min_num_pixels)
+    imsave(output_file, im, backend='cv2')
+
+def full_segment_image(input_file, output_file, fiji_exe, fiji_script, min_num_pixels,
+                       tile_size=None, tile_threads=1):
+    """Run the segmentation and write out the image.
+
+    If tile_size is given the fiji output is memory mapped and the objects
+    are colored tile by tile, spread over tile_threads threads.
+    """
+    from tiling import tile_map
+    tiled = tile_size is not None
+    numpy_im = segment_image(input_file, fiji_exe, fiji_script, mapped=tiled)
+    with tile_map(tile_threads) as mapper:
+        colored_im = color_objects(numpy_im, min_num_pixels=min_num_pixels,
+                                   tile_size=tile_size, mapper=mapper)
     save_image(colored_im, output_file)
-    saved_im = cv2.imread(output_file, -1)
+    if tiled:
+        saved_im = imread_mapped(output_file, backend='cv2')
+    else:
+        saved_im = imread(output_file, backend='cv2')
     logger.info('Max value of object in saved output: {}'.format(
                                             np.max(saved_im)))
 
@@ -82,7 +133,9 @@ def main(args):
                        args.output_file,
                        args.fiji_exe,
                        args.fiji_script,
-                       args.min_num_pixels)
+                       args.min_num_pixels,
+                       args.tile_size,
+                       args.tile_threads)
 
 
 if __name__ == '__main__':
@@ -93,6 +146,10 @@ if __name__ == '__main__':
                         help='Minimum particle size')
     parser.add_argument('-s', '--fiji_script', default=None, help='Location of fiji script')
     parser.add_argument('-f', '--fiji_exe', default='fiji', help='Location of fiji executable')
+    parser.add_argument('-t', '--tile_size', default=None, type=int,
+                        help='Color the objects in tiles of this size')
+    parser.add_argument('--tile_threads', default=1, type=int,
+                        help='Number of threads coloring the tiles')
 
     args = parser.parse_args()
 
@@ -1,31 +1,38 @@
 import argparse
 import numpy as np
-from skimage.io import use_plugin, imread, imsave
-from skimage.morphology import binary_erosion, disk
-from skimage.color import rgb2grey
 
-def generate_segmentation_outline(input_file, output_file):
-    """Erode and subtract to generate segmentation outline."""
-    use_plugin('freeimage')
+from image_io import imread, imsave
 
-    segmentation_im = imread(input_file)
-    segmentation_grey_im = segmentation_im
-    if len(segmentation_im.shape) > 2:
-        segmentation_grey_im = rgb2grey(segmentation_im)
+def outline_mask(label_im):
+    """Return boolean mask of the pixels on the outlines of labelled regions.
+
+    A non-zero pixel is on an outline if any of its four neighbours has a
+    different label; pixels outside the image count as background. Unlike
+    eroding a binary mask this also separates regions that touch.
+    """
+    padded = np.pad(label_im, 1, mode='constant')
+    centre = padded[1:-1, 1:-1]
+    boundary = ((centre != padded[:-2, 1:-1])
+                | (centre != padded[2:, 1:-1])
+                | (centre != padded[1:-1, :-2])
+                | (centre != padded[1:-1, 2:]))
+    return boundary & (centre != 0)
 
-    binary_mask_im = (segmentation_grey_im != 0)
-    salem = disk(1)
-    erosion_mask_im = binary_erosion(binary_mask_im, salem)
-    outline_mask_im = np.logical_xor(binary_mask_im, erosion_mask_im)
+def rgb_to_label(rgb_im):
+    """Return 2D label image with one label per colour of an rgb image."""
+    rgb_im = rgb_im.astype(np.uint32)
+    return (rgb_im[:,:,0] << 16) | (rgb_im[:,:,1] << 8) | rgb_im[:,:,2]
+
+def generate_segmentation_outline(input_file, output_file):
+    """Generate segmentation outline from a label or rgb mask image."""
+    segmentation_im = imread(input_file)
 
     if len(segmentation_im.shape) > 2:
-        im = np.zeros(segmentation_im.shape, dtype=np.uint8)
-        for i in range(3):
-            im[:,:,i] = segmentation_im[:,:,i] * outline_mask_im
-        imsave(output_file, im)
+        outline_mask_im = outline_mask(rgb_to_label(segmentation_im))
+        imsave(output_file, segmentation_im * outline_mask_im[:,:,np.newaxis])
     else:
-        output_im = segmentation_im * outline_mask_im
-        imsave(output_file, output_im)
+        outline_mask_im = outline_mask(segmentation_im)
+        imsave(output_file, segmentation_im * outline_mask_im)
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
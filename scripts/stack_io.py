@@ -0,0 +1,203 @@
+"""Single file containers for stacks of 2D images.
+
+A stack file holds all the z-slices of one channel of a series. It starts
+with a small header followed by the raw image data, which means that the
+whole stack can be memory mapped with a single open call rather than
+decoding one image file per slice.
+
+File layout:
+
+- 8 bytes magic string
+- 4 bytes little-endian unsigned int: length of the JSON header
+- JSON header with the dtype, shape (z, x, y) and the slice names,
+  padded with spaces so that the data starts on a 64 byte boundary
+- C-ordered image data
+"""
+
+import os
+import json
+import struct
+import argparse
+from itertools import islice
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from workflow import dir_index
+from label_store import image_fname, is_label_file
+from image_io import imread
+
+import logging
+logger = logging.getLogger('__main__.{}'.format(__name__))
+
+STACK_SUFFIX = '.stack'
+MAGIC = 'RIASTACK'
+ALIGNMENT = 64
+
+# Number of threads used to decode images and the number of images decoded
+# ahead of the one being consumed.
+DECODE_THREADS = 4
+READ_AHEAD = 8
+
+def is_stack(path):
+    """Wether or not the path is a stack file (rather than a directory)."""
+    return path.endswith(STACK_SUFFIX)
+
+def channel_path(root_dir, channel):
+    """Return path to the stack file of a channel if it exists.
+
+    Otherwise return the path to the directory of images of the channel.
+    """
+    stack_file = os.path.join(root_dir, channel + STACK_SUFFIX)
+    if dir_index.isfile(stack_file):
+        return stack_file
+    return os.path.join(root_dir, channel)
+
+def read_header(stack_file):
+    """Return the header dictionary and the offset of the data."""
+    with open(stack_file, 'rb') as fh:
+        magic = fh.read(len(MAGIC))
+        if magic != MAGIC:
+            raise IOError('Not a stack file: {}'.format(stack_file))
+        header_len, = struct.unpack('<I', fh.read(4))
+        header = json.loads(fh.read(header_len))
+    offset = len(MAGIC) + 4 + header_len
+    return header, offset
+
+def read_stack(stack_file):
+    """Return memory mapped array of shape (z, x, y) from a stack file."""
+    header, offset = read_header(stack_file)
+    return np.memmap(stack_file, dtype=np.dtype(header['dtype']), mode='r',
+                     offset=offset, shape=tuple(header['shape']))
+
+def write_stack(stack_file, images, names=None):
+    """Write a sequence of 2D images to a stack file.
+
+    The images are written one at a time, so ``images`` can be a lazy
+    sequence, but its length must be known up front. Each image is
+    decoded once; the first one gives the shape and dtype of the stack.
+
+    :param stack_file: output file path
+    :param images: sequence of 2D arrays with the same shape and dtype
+    :param names: optional slice names, e.g. the original file names
+    """
+    num_images = len(images)
+    images = iter(images)
+    first = next(images)
+    shape, dtype = first.shape, first.dtype
+    if names is None:
+        names = ['z{:d}.tif'.format(z) for z in range(num_images)]
+    header = json.dumps({'dtype': dtype.str,
+                         'shape': [num_images] + list(shape),
+                         'names': list(names)})
+    header_len = len(header) + (-(len(MAGIC) + 4 + len(header)) % ALIGNMENT)
+    with open(stack_file, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack('<I', header_len))
+        fh.write(header.ljust(header_len))
+        np.ascontiguousarray(first).tofile(fh)
+        for im in images:
+            if im.shape != shape:
+                raise ValueError('Slices in a stack must have the same shape.')
+            np.ascontiguousarray(im, dtype=dtype).tofile(fh)
+
+class _LazyImages(object):
+    """Sequence of images decoded on access.
+
+    Iterating reads every image into the same buffer, so each image must be
+    consumed before the next one is read.
+    """
+
+    def __init__(self, fpaths):
+        self.fpaths = fpaths
+
+    def __len__(self):
+        return len(self.fpaths)
+
+    def __getitem__(self, i):
+        return imread(self.fpaths[i])
+
+    def __iter__(self):
+        buf = None
+        for fpath in self.fpaths:
+            buf = imread(fpath, out=buf)
+            yield buf
+
+def pack_files(fpaths, stack_file):
+    """Write a list of image files to a stack file.
+
+    The slice order is that of the list.
+    """
+    names = [os.path.basename(image_fname(fp)) for fp in fpaths]
+    write_stack(stack_file, _LazyImages(fpaths), names)
+
+def slice_names(path):
+    """Return the names of the slices in a directory or stack file.
+
+    If a directory holds label files only those are slices; the images
+    next to them are left over from writing the slices as images.
+    """
+    # Imported here as reconstructor imports this module.
+    from reconstructor import sorted_nicely
+    if is_stack(path):
+        header, _ = read_header(path)
+        return header['names']
+    fnames = dir_index.listdir(path)
+    label_fnames = [fname for fname in fnames if is_label_file(fname)]
+    return sorted_nicely(label_fnames or fnames)
+
+def iread_images(fpaths, reader=imread, num_threads=DECODE_THREADS,
+                 read_ahead=READ_AHEAD):
+    """Yield the images in the files in order, decoding them in threads.
+
+    At most read_ahead images are decoded ahead of the one being consumed,
+    which bounds the memory used by images waiting to be consumed. Decoding
+    mostly releases the GIL so disk latency and decompression overlap.
+
+    :param fpaths: iterable of file paths
+    :param reader: function returning the decoded image of a file path
+    :param num_threads: number of decoding threads; 1 decodes serially
+    :param read_ahead: maximum number of images decoded ahead
+    """
+    if num_threads <= 1:
+        for fpath in fpaths:
+            yield reader(fpath)
+        return
+
+    fpaths = iter(fpaths)
+    pool = ThreadPool(num_threads)
+    try:
+        pending = deque(pool.apply_async(reader, (fpath,))
+                        for fpath in islice(fpaths, max(read_ahead, 1)))
+        while pending:
+            im = pending.popleft().get()
+            for fpath in islice(fpaths, 1):
+                pending.append(pool.apply_async(reader, (fpath,)))
+            yield im
+    finally:
+        pool.terminate()
+
+def load_images(path, num_threads=DECODE_THREADS):
+    """Return list of 2D images from a directory or a stack file.
+
+    The images in a directory are sorted nicely by file name and decoded in
+    num_threads threads. The images in a stack file are memory mapped rather
+    than read.
+    """
+    if is_stack(path):
+        return list(read_stack(path))
+    fpaths = [os.path.join(path, fname) for fname in slice_names(path)]
+    return list(iread_images(fpaths, num_threads=num_threads))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('input_dir', help="Directory containing the slices")
+    parser.add_argument('stack_file', help="Output stack file")
+    args = parser.parse_args()
+    fpaths = [os.path.join(args.input_dir, fname)
+              for fname in slice_names(args.input_dir)]
+    pack_files(fpaths, args.stack_file)
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,20 @@
 import argparse
 
 import numpy as np
-from skimage.io import use_plugin, imread
 
-use_plugin('freeimage')
+from image_io import imread
+
+from label_store import is_label_file, LabelImage
 
 def sum_segmented_area(segmentation_file):
 
+    if is_label_file(segmentation_file):
+        # The number of non-zero pixels is stored in the header.
+        return LabelImage(segmentation_file).nonzero
+
     im_array = imread(segmentation_file)
 
-    area = len(np.where(im_array != 0)[0])
+    area = int(np.count_nonzero(im_array))
 
     return area
 
@@ -2,24 +2,91 @@
 
 import os
 import argparse
+from multiprocessing import Pool
+
+import numpy as np
 
 from sum_segmentation_area import sum_segmented_area
+from workflow import PARTIAL_PREFIX
+from stack_io import is_stack, read_stack, slice_names
+from label_store import is_label_file
 
 def sum_segmentation_dir(segmentation_dir):
-    all_seg_files = os.listdir(segmentation_dir)
+    if is_stack(segmentation_dir):
+        return sum(int(np.count_nonzero(im_array))
+                   for im_array in read_stack(segmentation_dir))
+
+    all_seg_files = slice_names(segmentation_dir)
 
     full_file_paths = [os.path.join(segmentation_dir, sf) for sf in all_seg_files]
 
     return sum(map(sum_segmented_area, full_file_paths))
 
+def _segmentation_tasks(root_dir, dir_name):
+    """Yield (directory, file path) for the segmentations under root_dir."""
+    for dirpath, dirnames, fnames in os.walk(root_dir):
+        dirnames.sort()
+        if os.path.basename(dirpath) != dir_name:
+            continue
+        fnames = [fname for fname in fnames
+                  if not fname.startswith(PARTIAL_PREFIX)]
+        # Images next to label files are left over; see slice_names.
+        label_fnames = [fname for fname in fnames if is_label_file(fname)]
+        for fname in sorted(label_fnames or fnames):
+            yield dirpath, os.path.join(dirpath, fname)
+
+def _sum_task(task):
+    """Return (directory, area) of a (directory, file path) task."""
+    dirpath, fpath = task
+    return dirpath, sum_segmented_area(fpath)
+
+def sum_segmentation_tree(root_dir, dir_name='RemoveBorderSegmentations',
+                          num_workers=4, chunksize=8):
+    """Yield (directory, area) for each segmentation directory under root_dir.
+
+    The files are read by a pool of worker processes while the tree is
+    still being walked. Each directory is yielded as soon as all its files
+    have been summed.
+
+    :param dir_name: name of the directories containing segmentations
+    """
+    pool = Pool(num_workers)
+    try:
+        current_dir, current_area = None, 0
+        for dirpath, area in pool.imap(_sum_task,
+                                       _segmentation_tasks(root_dir, dir_name),
+                                       chunksize):
+            if dirpath != current_dir:
+                if current_dir is not None:
+                    yield current_dir, current_area
+                current_dir, current_area = dirpath, 0
+            current_area += area
+        if current_dir is not None:
+            yield current_dir, current_area
+    finally:
+        pool.terminate()
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
 
     parser.add_argument('segmentation_dir', help='Directory containing segmentations.')
+    parser.add_argument('--tree', action='store_true',
+                        help='Sum every segmentation directory under segmentation_dir')
+    parser.add_argument('--dir_name', default='RemoveBorderSegmentations',
+                        help='Name of the segmentation directories (with --tree)')
+    parser.add_argument('--num_workers', default=4, type=int,
+                        help='Number of worker processes (with --tree)')
 
     args = parser.parse_args()
 
+    if args.tree:
+        for dirpath, area in sum_segmentation_tree(args.segmentation_dir,
+                                                   args.dir_name,
+                                                   args.num_workers):
+            print '{},{}'.format(dirpath, area)
+        return
+
     print sum_segmentation_dir(args.segmentation_dir)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
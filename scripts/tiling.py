@@ -0,0 +1,174 @@
+"""Tiled processing of large 2D images.
+
+A large image, e.g. a mosaic acquisition, is processed as a grid of tiles
+so that the temporary arrays of a filter only ever cover one tile. Each
+tile is processed with a halo of surrounding pixels; as long as the halo is
+at least the radius of the filter the core of every tile is exactly what
+processing the whole image would have given, and the cores are written to
+the output image.
+
+Connected components can not be found with a halo of any fixed size, so
+labels are found tile by tile and stitched across the tile seams instead.
+"""
+
+from itertools import izip
+from contextlib import contextmanager
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('__main__.{}'.format(__name__))
+
+TILE_SIZE = 1024
+
+# core: (x slice, y slice) of the tile in the image.
+# padded: (x slice, y slice) of the tile and its halo in the image.
+# inner: (x slice, y slice) of the core in the padded tile.
+Tile = namedtuple('Tile', ['core', 'padded', 'inner'])
+
+def iter_tiles(shape, tile_size=TILE_SIZE, halo=0):
+    """Yield the :class:`Tile` of a grid of tiles in row-major order.
+
+    The halo is clipped at the image border.
+
+    :param shape: shape of the image; only the first two axes are tiled
+    :param tile_size: width of the (core of the) tiles
+    :param halo: width of the margin around the core of a tile
+    """
+    xdim, ydim = shape[:2]
+    for x0 in range(0, xdim, tile_size):
+        x1 = min(x0 + tile_size, xdim)
+        px0, px1 = max(x0 - halo, 0), min(x1 + halo, xdim)
+        for y0 in range(0, ydim, tile_size):
+            y1 = min(y0 + tile_size, ydim)
+            py0, py1 = max(y0 - halo, 0), min(y1 + halo, ydim)
+            yield Tile((slice(x0, x1), slice(y0, y1)),
+                       (slice(px0, px1), slice(py0, py1)),
+                       (slice(x0 - px0, x1 - px0), slice(y0 - py0, y1 - py0)))
+
+@contextmanager
+def tile_map(num_threads=1):
+    """Return map function spreading the tiles over num_threads threads.
+
+    The results are returned in order as they are ready rather than
+    collected in a list. With one thread it is the builtin map.
+    """
+    if num_threads <= 1:
+        yield map
+        return
+    pool = ThreadPool(num_threads)
+    try:
+        yield pool.imap
+    finally:
+        pool.terminate()
+
+def map_tiles(func, im, tile_size=TILE_SIZE, halo=0, out=None, dtype=None,
+              mapper=map):
+    """Apply a filter to an image tile by tile.
+
+    :param func: function returning the filtered image of a padded tile;
+                 the result must have the shape of the tile in its first
+                 two axes
+    :param im: input image; it can be a memory mapped array
+    :param tile_size: width of the tiles
+    :param halo: width of the margin of image around each tile passed to
+                 func; at least the radius of the filter
+    :param out: optional output array of the shape of the filtered image
+    :param dtype: dtype of the output array if out is not given; by default
+                  that of the result of the first tile
+    :param mapper: map function used to filter the tiles, e.g. that of
+                   :func:`tile_map`; the results are collected in
+                   row-major order
+    :returns: the filtered image; out if given
+    """
+    tiles = list(iter_tiles(im.shape, tile_size, halo))
+
+    def process(tile):
+        return func(im[tile.padded])[tile.inner]
+
+    for tile, core in izip(tiles, map_lazily(mapper, process, tiles)):
+        if out is None:
+            out = np.empty(im.shape[:2] + core.shape[2:],
+                           dtype=core.dtype if dtype is None else dtype)
+        out[tile.core] = core
+    return out
+
+def map_lazily(mapper, func, items):
+    """Return iterator over the results of a map function.
+
+    The builtin map is replaced by a generator, so that the results are
+    computed as they are consumed.
+    """
+    if mapper is map:
+        return (func(item) for item in items)
+    return mapper(func, items)
+
+def label_tiles(mask, tile_size=TILE_SIZE, out=None, mapper=map):
+    """Return the connected components of a binary image found tile by tile.
+
+    The components are those of :func:`scipy.ndimage.label` with its default
+    (4-connected) structure, numbered in the same order, i.e. that of their
+    first pixel in row-major order.
+
+    :param mask: 2D binary image; it can be a memory mapped array
+    :param tile_size: width of the tiles
+    :param out: optional int32 output array
+    :param mapper: map function used to label the tiles, see :func:`map_tiles`
+    :returns: (labels, number of components)
+    """
+    from scipy.ndimage import label
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    xdim, ydim = mask.shape
+    if out is None:
+        out = np.zeros(mask.shape, dtype=np.int32)
+
+    def label_tile(tile):
+        tile_labels, n = label(mask[tile.core])
+        ids, first = np.unique(tile_labels, return_index=True)
+        xs, ys = np.unravel_index(first[ids > 0], tile_labels.shape)
+        return tile_labels, n, (xs + tile.core[0].start) * ydim + ys + tile.core[1].start
+
+    # Label the tiles with consecutive ids; record the first pixel of each id.
+    num_labels = 0
+    firsts = [np.zeros(1, dtype=np.int64)]
+    tiles = list(iter_tiles(mask.shape, tile_size))
+    labelled = map_lazily(mapper, label_tile, tiles)
+    for tile, (tile_labels, n, first) in izip(tiles, labelled):
+        firsts.append(first)
+        tile_labels[tile_labels > 0] += num_labels
+        out[tile.core] = tile_labels
+        num_labels += n
+    firsts = np.concatenate(firsts)
+
+    # Join the labels of foreground pixels on either side of a seam.
+    rows = []
+    cols = []
+    for x in range(tile_size, xdim, tile_size):
+        rows.append(out[x-1, :])
+        cols.append(out[x, :])
+    for y in range(tile_size, ydim, tile_size):
+        rows.append(out[:, y-1])
+        cols.append(out[:, y])
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int32)
+    joined = (rows > 0) & (cols > 0)
+    graph = coo_matrix((np.ones(joined.sum()), (rows[joined], cols[joined])),
+                       shape=(num_labels + 1, num_labels + 1))
+    _, components = connected_components(graph, directed=False)
+
+    # Number the components in order of their first pixel.
+    component_first = np.full(components.max() + 1, np.iinfo(np.int64).max)
+    np.minimum.at(component_first, components[1:], firsts[1:])
+    component_first[components[0]] = -1
+    order = np.argsort(component_first, kind='mergesort')
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order))
+    lut = rank[components]
+    lut[0] = 0
+
+    for tile in iter_tiles(mask.shape, tile_size):
+        out[tile.core] = lut[out[tile.core]]
+    return out, len(order) - 1
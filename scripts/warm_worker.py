@@ -0,0 +1,38 @@
+"""Worker processes with the image analysis modules preloaded."""
+
+from multiprocessing import Pool
+
+import logging
+logger = logging.getLogger('__main__.{}'.format(__name__))
+
+IMAGE_BACKENDS = ('pil', 'freeimage', 'cv2')
+
+_WARM = False
+
+def warm_up():
+    """Import the heavy modules and load the image backends.
+
+    Only does the work the first time it is called in a process.
+    """
+    global _WARM
+    if _WARM:
+        return
+    import scipy.ndimage
+    import skimage.io
+    import skimage.color
+    import skimage.filter
+    import skimage.morphology
+    import PIL.Image
+    from image_io import load_backends
+    load_backends(IMAGE_BACKENDS)
+    _WARM = True
+    logger.info('Worker warmed up.')
+
+def warm_pool(num_workers):
+    """Return a pool of reusable worker processes that have been warmed up.
+
+    The modules are loaded in the parent process before the pool is created
+    so that forked workers inherit them rather than importing them again.
+    """
+    warm_up()
+    return Pool(num_workers, initializer=warm_up)
@@ -3,13 +3,33 @@
 import os
 import inspect
 import json
-from collections import OrderedDict
+import stat
+import random
+import threading
+import time
+import cProfile
+import pstats
+from collections import OrderedDict, deque
 import logging
 
 from collections import namedtuple
 
 import copy_reg
 import types
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 __version__ = 0.3
 
@@ -33,23 +53,813 @@ def setup_logger(name):
     return logger
 logger = setup_logger(__name__)
 
+#############################################################################
+# Directory index.
+#############################################################################
+
+# Prefix of files that are still being written, see _BaseNode.atomic_output.
+PARTIAL_PREFIX = '.partial-'
+
+# Modification time of the files planned in dry runs.
+PLANNED_MTIME = float('inf')
+
+class DirectoryIndex(object):
+    """Snapshot of directory listings and file modification times.
+
+    Each directory is scanned at most once; the names, whether or not they
+    are files and their modification times are kept in memory. This avoids
+    repeated ``listdir`` and ``stat`` calls, which are expensive on network
+    file systems.
+
+    The index needs to be told about files written after a directory has
+    been scanned, see :func:`workflow.DirectoryIndex.record` and
+    :func:`workflow.DirectoryIndex.invalidate`.
+
+    Files that are still being written are not indexed.
+    """
+
+    def __init__(self):
+        self._dirs = {}
+        self._lock = threading.Lock()
+        self._active_runs = 0
+
+    def _scan(self, directory):
+        """Return dictionary of name -> (is_file, mtime) for the directory."""
+        snapshot = {}
+        if scandir is not None:
+            for entry in scandir(directory):
+                if entry.name.startswith(PARTIAL_PREFIX):
+                    continue
+                try:
+                    is_file = entry.is_file()
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                snapshot[entry.name] = (is_file, mtime)
+        else:
+            for name in os.listdir(directory):
+                if name.startswith(PARTIAL_PREFIX):
+                    continue
+                try:
+                    st = os.stat(os.path.join(directory, name))
+                except OSError:
+                    continue
+                snapshot[name] = (stat.S_ISREG(st.st_mode), st.st_mtime)
+        return snapshot
+
+    def _snapshot(self, directory):
+        """Return the (cached) snapshot of a directory.
+
+        :raises: OSError if the directory does not exist
+        """
+        key = os.path.abspath(directory)
+        with self._lock:
+            try:
+                return self._dirs[key]
+            except KeyError:
+                pass
+        snapshot = self._scan(directory)
+        with self._lock:
+            self._dirs[key] = snapshot
+        return snapshot
+
+    def listdir(self, directory):
+        """Return list of names in the directory.
+
+        :raises: OSError if the directory does not exist
+        """
+        return list(self._snapshot(directory).keys())
+
+    def _lookup(self, path):
+        """Return (is_file, mtime) for the path or None if it does not exist."""
+        directory, name = os.path.split(os.path.abspath(path))
+        try:
+            return self._snapshot(directory).get(name)
+        except OSError:
+            return None
+
+    def isfile(self, path):
+        """Wether or not the path is an existing file."""
+        info = self._lookup(path)
+        return info is not None and info[0]
+
+    def getmtime(self, path):
+        """Return the modification time of the path.
+
+        :raises: OSError if the path does not exist
+        """
+        info = self._lookup(path)
+        if info is None:
+            raise OSError('No such file: {}'.format(path))
+        return info[1]
+
+    def record(self, path):
+        """Update the index with a file that has been (re)written."""
+        directory, name = os.path.split(os.path.abspath(path))
+        with self._lock:
+            snapshot = self._dirs.get(directory)
+        if snapshot is None:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            snapshot.pop(name, None)
+            return
+        snapshot[name] = (stat.S_ISREG(st.st_mode), st.st_mtime)
+
+    def plan(self, path):
+        """Record a file that is going to be written, without writing it.
+
+        Used for dry runs. A planned file exists and is more recent than any
+        file on disk, which makes everything downstream of it stale.
+        """
+        directory, name = os.path.split(os.path.abspath(path))
+        self.plan_directory(directory)
+        with self._lock:
+            self._dirs[directory][name] = (True, PLANNED_MTIME)
+
+    def plan_directory(self, directory):
+        """Record a directory that is going to be created, for dry runs."""
+        try:
+            self._snapshot(directory)
+        except OSError:
+            with self._lock:
+                self._dirs.setdefault(os.path.abspath(directory), {})
+
+    def invalidate(self, directory=None):
+        """Forget a directory, or all directories if none is given."""
+        with self._lock:
+            if directory is None:
+                self._dirs.clear()
+            else:
+                self._dirs.pop(os.path.abspath(directory), None)
+
+    def invalidate_tree(self, directory):
+        """Forget a directory and all the directories below it."""
+        key = os.path.abspath(directory)
+        prefix = os.path.join(key, '')
+        with self._lock:
+            for path in list(self._dirs.keys()):
+                if path == key or path.startswith(prefix):
+                    del self._dirs[path]
+
+    def begin_run(self, paths):
+        """Start a run of a workflow reading and writing the given paths.
+
+        A run that does not overlap with other runs starts from an empty
+        index, so that files changed since an earlier run in the same
+        process are seen. A run started while others are in progress, e.g.
+        concurrent series, only forgets the directories of its own paths
+        and those below them, keeping the snapshots of the other runs.
+
+        :param paths: input and output directories and files of the run
+        """
+        with self._lock:
+            overlapping = self._active_runs > 0
+            self._active_runs += 1
+            if not overlapping:
+                self._dirs.clear()
+        if overlapping:
+            for path in paths:
+                self.invalidate_tree(path)
+                self.invalidate(os.path.dirname(os.path.abspath(path)))
+
+    def end_run(self):
+        """End a run started with :func:`DirectoryIndex.begin_run`."""
+        with self._lock:
+            self._active_runs -= 1
+
+dir_index = DirectoryIndex()
+
+#############################################################################
+# Journal of completed tasks.
+#############################################################################
+
+JOURNAL_FNAME = 'journal.log'
+
+class Journal(object):
+    """Append-only journals of completed outputs.
+
+    Each line of a journal file records the path and modification time of
+    an output file that has been written completely. Journal files are
+    read at most once and are appended to from the worker processes.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _load(self, journal_file):
+        """Return dictionary of output path -> mtime from a journal file."""
+        entries = {}
+        try:
+            with open(journal_file) as fh:
+                for line in fh:
+                    try:
+                        fpath, mtime = json.loads(line)
+                    except ValueError:
+                        # Line cut short by a crash.
+                        continue
+                    entries[fpath] = mtime
+        except IOError:
+            pass
+        return entries
+
+    def _journal(self, journal_file):
+        """Return the (cached) entries of a journal file."""
+        with self._lock:
+            try:
+                return self._entries[journal_file]
+            except KeyError:
+                pass
+        entries = self._load(journal_file)
+        with self._lock:
+            return self._entries.setdefault(journal_file, entries)
+
+    def getmtime(self, journal_file, output_file):
+        """Return the mtime of the output when it was completed or None."""
+        return self._journal(journal_file).get(os.path.abspath(output_file))
+
+    def record(self, journal_file, output_file):
+        """Append a completed output file to the journal."""
+        fpath = os.path.abspath(output_file)
+        mtime = os.path.getmtime(fpath)
+        with open(journal_file, 'a') as fh:
+            fh.write(json.dumps([fpath, mtime]) + '\n')
+        with self._lock:
+            entries = self._entries.get(journal_file)
+        if entries is not None:
+            entries[fpath] = mtime
+
+    def discard(self, journal_file, output_file):
+        """Drop the cached entry of an output that has changed on disk."""
+        fpath = os.path.abspath(output_file)
+        with self._lock:
+            entries = self._entries.get(journal_file)
+            if entries is not None:
+                entries.pop(fpath, None)
+
+    def forget(self, journal_file):
+        """Forget the cached entries of a journal file."""
+        with self._lock:
+            self._entries.pop(journal_file, None)
+
+journal = Journal()
+
+#############################################################################
+# Scheduling.
+#############################################################################
+
+DEFAULT_RESOURCE_CLASS = 'default'
+
+def resource_class(node):
+    """Return the resource class of a node.
+
+    A node declares its resource class using a ``resource_class`` setting,
+    e.g. 'fiji' for nodes whose tasks need a lot of memory.
+    """
+    return getattr(node.settings, 'resource_class', DEFAULT_RESOURCE_CLASS)
+
+class _MemoryBudget(object):
+    """Amount of memory (MB) shared by the tasks running at the same time.
+
+    A task that needs more than the whole budget runs on its own.
+    """
+
+    def __init__(self, limit_mb):
+        self.limit_mb = limit_mb
+        self.used_mb = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, mb, blocking=True):
+        with self._cond:
+            while self.used_mb > 0 and self.used_mb + mb > self.limit_mb:
+                if not blocking:
+                    return False
+                self._cond.wait()
+            self.used_mb += mb
+            return True
+
+    def release(self, mb):
+        with self._cond:
+            self.used_mb -= mb
+            self._cond.notify_all()
+
+class ResourceScheduler(object):
+    """Mapper that limits the number of concurrent tasks per resource class.
+
+    All tasks are executed by one shared pool of workers. Tasks of a
+    resource class with a limit only start when one of the class's slots is
+    free, leaving the remaining workers to tasks of other classes. This is
+    useful when several workflows are run from different threads.
+
+    Given a memory limit, tasks of a resource class with a memory budget
+    only start when their budget fits in what the running tasks leave of
+    the limit. Nodes that implement process() rather than tasks take part
+    through :meth:`reserve`.
+
+    The resource class is looked up from the node that the mapped function
+    is bound to, i.e. ``scheduler(node.execute, tasks)``.
+
+    :param pool: :class:`multiprocessing.Pool` like object; if None tasks
+                 are executed in the calling thread
+    :param limits: dictionary of resource class -> maximum concurrent tasks
+    :param memory_limit_mb: memory available to concurrent tasks in MB
+    :param memory_budgets: dictionary of resource class -> memory needed by
+                           a task in MB
+    """
+
+    def __init__(self, pool, limits=None, memory_limit_mb=None,
+                 memory_budgets=None):
+        self.pool = pool
+        self._slots = {}
+        if limits is not None:
+            for name, limit in limits.items():
+                self._slots[name] = threading.BoundedSemaphore(limit)
+        self._memory = None
+        if memory_limit_mb is not None:
+            self._memory = _MemoryBudget(memory_limit_mb)
+        self._budgets = dict(memory_budgets or {})
+
+    def _resources(self, node):
+        """Return the slots and memory budget of the node's tasks."""
+        if node is None:
+            return None, 0
+        name = resource_class(node)
+        task_mb = 0
+        if self._memory is not None:
+            task_mb = self._budgets.get(name, 0)
+        return self._slots.get(name), task_mb
+
+    def __call__(self, func, iterable):
+        node = getattr(func, '__self__', None)
+        slots, task_mb = self._resources(node)
+        if self.pool is None:
+            results = []
+            for item in iterable:
+                with self.reserve(node):
+                    results.append(func(item))
+            return results
+        if slots is None and not task_mb:
+            return self.pool.map(func, iterable)
+
+        results = []
+        in_flight = deque()
+        for item in iterable:
+            self._acquire(slots, task_mb, in_flight)
+            async_result = self.pool.apply_async(func, (item,))
+            in_flight.append(async_result)
+            results.append(async_result)
+        while in_flight:
+            in_flight.popleft().wait()
+            self._release(slots, task_mb)
+        return [async_result.get() for async_result in results]
+
+    @contextmanager
+    def reserve(self, node):
+        """Context manager holding the resources of one task of the node."""
+        slots, task_mb = self._resources(node)
+        if slots is not None:
+            slots.acquire()
+        try:
+            if task_mb:
+                self._memory.acquire(task_mb)
+            try:
+                yield
+            finally:
+                if task_mb:
+                    self._memory.release(task_mb)
+        finally:
+            if slots is not None:
+                slots.release()
+
+    def _try_acquire(self, slots, task_mb):
+        """Acquire a slot and the memory budget if both are free."""
+        if slots is not None and not slots.acquire(False):
+            return False
+        if task_mb and not self._memory.acquire(task_mb, blocking=False):
+            if slots is not None:
+                slots.release()
+            return False
+        return True
+
+    def _release(self, slots, task_mb):
+        if slots is not None:
+            slots.release()
+        if task_mb:
+            self._memory.release(task_mb)
+
+    def _acquire(self, slots, task_mb, in_flight):
+        """Acquire a slot and memory, freeing up our own if need be."""
+        while not self._try_acquire(slots, task_mb):
+            if not in_flight:
+                # All the resources are held by other threads.
+                if slots is not None:
+                    slots.acquire()
+                if task_mb:
+                    self._memory.acquire(task_mb)
+                return
+            in_flight.popleft().wait()
+            self._release(slots, task_mb)
+
+@contextmanager
+def _reserve(mapper, node):
+    """Hold the resources of the node if the mapper schedules resources."""
+    reserve = getattr(mapper, 'reserve', None)
+    if reserve is None:
+        yield
+    else:
+        with reserve(node):
+            yield
+
+#############################################################################
+# Memory tracking.
+#############################################################################
+
+PROC_STATUS = '/proc/self/status'
+PROC_CLEAR_REFS = '/proc/self/clear_refs'
+
+def _status_mb(field):
+    """Return a memory field of the process status in MB, or None.
+
+    Only available on Linux.
+    """
+    try:
+        with open(PROC_STATUS) as fh:
+            for line in fh:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+def rss_mb():
+    """Return the current resident set size of the process in MB or None."""
+    return _status_mb('VmRSS')
+
+def peak_rss_mb():
+    """Return the peak resident set size of the process in MB or None.
+
+    The peak is that since the last :func:`reset_peak_rss`.
+    """
+    return _status_mb('VmHWM')
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the process to its current size.
+
+    ``ru_maxrss`` can not be reset, and pool workers are reused and forked
+    workers inherit the peak of their parent, so it does not tell the peak
+    of a single task. Linux resets the peak through clear_refs.
+
+    :returns: True if the peak was reset
+    """
+    try:
+        with open(PROC_CLEAR_REFS, 'w') as fh:
+            fh.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def memory_tracing_available():
+    """Whether or not memory allocations can be traced (Python 3.4+)."""
+    return tracemalloc is not None
+
+def memory_call(trace, func, *args):
+    """Return the result of a call and its memory usage.
+
+    The usage is a dictionary with the peak resident set size of the
+    process during the call ('peak_rss_mb') and how much that is above
+    the size before the call ('rss_increase_mb'). Where the peak can not be
+    reset the larger of the sizes before and after the call is reported
+    instead. Calls running at the same time in threads of one process
+    share the measurement. On other systems than Linux no sizes are
+    reported.
+
+    If trace is True the peak memory traced during the call
+    ('traced_peak_mb') is reported as well. Only the call that starts
+    tracing reports a traced peak, so calls running at the same time in
+    threads report theirs once.
+
+    :raises: RuntimeError if trace is True and tracemalloc is not available
+    """
+    if trace and not memory_tracing_available():
+        raise RuntimeError('Tracing memory needs tracemalloc (Python 3.4+).')
+    traced = trace and not tracemalloc.is_tracing()
+    if traced:
+        tracemalloc.start()
+    try:
+        before_mb = rss_mb()
+        reset = reset_peak_rss()
+        result = func(*args)
+        if reset:
+            peak_mb = peak_rss_mb()
+        else:
+            after_mb = rss_mb()
+            peak_mb = None if after_mb is None else max(before_mb, after_mb)
+        usage = {}
+        if peak_mb is not None:
+            usage['peak_rss_mb'] = peak_mb
+            usage['rss_increase_mb'] = peak_mb - before_mb
+        if traced:
+            usage['traced_peak_mb'] = \
+                tracemalloc.get_traced_memory()[1] / 1024.0**2
+    finally:
+        if traced:
+            tracemalloc.stop()
+    return result, usage
+
+def _peak_usage(usages):
+    """Return dictionary of the highest of each memory usage."""
+    peaks = {}
+    for usage in usages:
+        for key, value in usage.items():
+            if value is not None:
+                peaks[key] = max(value, peaks.get(key, value))
+    return peaks
+
+#############################################################################
+# Profiling.
+#############################################################################
+
+PROFILE_REPORT_FNAME = 'profile_report.txt'
+
+class _RawStats(object):
+    """Profile statistics in the form :class:`pstats.Stats` can load."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def _tracked_call(func, args, profile, trace_memory):
+    """Return result, raw profile statistics or None and memory usage."""
+    if profile:
+        (result, raw_stats), usage = memory_call(trace_memory, profile_call,
+                                                 func, *args)
+    else:
+        result, usage = memory_call(trace_memory, func, *args)
+        raw_stats = None
+    return result, raw_stats, usage
+
+def profile_call(func, *args):
+    """Return the result of a call and its raw profile statistics.
+
+    The raw statistics are a plain dictionary, so they can be returned
+    from a worker process.
+    """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args)
+    profiler.create_stats()
+    return result, profiler.stats
+
+class Profiling(object):
+    """Opt-in profiling of the nodes of workflow runs.
+
+    Pass an instance to :func:`workflow.run`. The process() call or the
+    tasks of the selected nodes are profiled where they run, including in
+    pool workers, and the statistics are merged into one
+    :class:`pstats.Stats` per node. Passing the same instance to several
+    runs, e.g. all the series of a treatment, aggregates their statistics.
+
+    :param nodes: names of the nodes to profile, e.g. 'Segmentation' or
+                  'Master/Segmentation'; all nodes if None
+    :param fraction: fraction of the tasks of a node that are profiled; at
+                     least one task per node is
+    :param seed: seed of the random selection of the profiled tasks
+    """
+
+    def __init__(self, nodes=None, fraction=1.0, seed=0):
+        self.nodes = nodes
+        self.fraction = fraction
+        self.stats = OrderedDict()
+        self.num_profiled = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def selects(self, node):
+        """Whether or not the node is profiled."""
+        if self.nodes is None:
+            return True
+        name = node_name(node)
+        return any(name == n or name.endswith('/' + n) for n in self.nodes)
+
+    def sample(self, tasks):
+        """Return list of booleans: whether or not to profile each task."""
+        with self._lock:
+            selected = [self._rng.random() < self.fraction for _ in tasks]
+        if tasks and not any(selected):
+            selected[0] = True
+        return selected
+
+    def add(self, name, raw_stats):
+        """Merge raw statistics from :func:`profile_call` into a node's."""
+        stats = pstats.Stats(_RawStats(raw_stats))
+        with self._lock:
+            if name in self.stats:
+                self.stats[name].add(stats)
+            else:
+                self.stats[name] = stats
+            self.num_profiled[name] = self.num_profiled.get(name, 0) + 1
+
+    def dump(self, directory, top=30):
+        """Write the statistics of each node and a summary report.
+
+        The statistics of a node are written to '<node>.prof', which can
+        be loaded with :mod:`pstats`; the report lists the top functions
+        of each node by cumulative time.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, PROFILE_REPORT_FNAME), 'w') as fh:
+            for name, stats in self.stats.items():
+                stats.dump_stats(os.path.join(
+                    directory, '{}.prof'.format(name.replace('/', '.'))))
+                fh.write('{} ({} profiled)\n'.format(
+                    name, self.num_profiled[name]))
+                stats.stream = fh
+                stats.sort_stats('cumulative').print_stats(top)
+
 #############################################################################
 # Workflow run function.
 #############################################################################
 
-def run(workflow, mapper=map):
-    """Run the workflow."""
-    if not os.path.isdir(workflow.output_directory):
+RUN_REPORT_FNAME = 'run_report.json'
+
+PlanEntry = namedtuple('PlanEntry', ['node', 'num_tasks', 'estimated_seconds'])
+
+def node_name(node):
+    """Return the name of the node prefixed by the names of its parents.
+
+    :returns: name, e.g. 'Master/RootMask'
+    """
+    name = node.__class__.__name__
+    if node._parent is None:
+        return name
+    return '{}/{}'.format(node_name(node._parent), name)
+
+def load_run_report(directory):
+    """Return the run report stored in the directory.
+
+    The run report is a dictionary of node names to the number of tasks
+    executed and the time it took during the last run that had any work.
+
+    :returns: dictionary, empty if no report exists
+    """
+    fpath = os.path.join(directory, RUN_REPORT_FNAME)
+    try:
+        with open(fpath) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+def save_run_report(directory, report):
+    """Write the run report to the directory."""
+    fpath = os.path.join(directory, RUN_REPORT_FNAME)
+    with open(fpath, 'w') as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+
+def _estimate_seconds(report_entry, num_tasks):
+    """Return estimated run time based on a run report entry."""
+    if report_entry is None or num_tasks is None:
+        return None
+    return num_tasks * float(report_entry['seconds']) / report_entry['tasks']
+
+def run(workflow, mapper=map, dry_run=False, profiling=None,
+        trace_memory=False):
+    """Run the workflow.
+
+    When running for real the time taken by each node and the peak memory
+    of its tasks are stored in a run report in the workflow's output
+    directory.
+
+    :param workflow: top-level node to run
+    :param mapper: map function used to execute the tasks of a node
+    :param dry_run: if True nothing is executed; instead the number of
+                    stale tasks of each node is worked out
+    :param profiling: optional :class:`workflow.Profiling` collecting the
+                      profile statistics of the nodes
+    :param trace_memory: also report the peak memory allocated by each
+                         node's tasks using tracemalloc
+    :returns: list of :class:`workflow.PlanEntry` if dry_run is True
+    :raises: RuntimeError if trace_memory is True and tracemalloc is not
+             available, see :func:`workflow.memory_tracing_available`
+    """
+    if trace_memory and not memory_tracing_available():
+        raise RuntimeError('Tracing memory needs tracemalloc (Python 3.4+).')
+    # Start each run with fresh snapshots of the workflow's inputs and
+    # outputs; see DirectoryIndex.begin_run for runs of other workflows
+    # using the index at the same time from other threads.
+    dir_index.begin_run([workflow.output_directory] + _input_paths(workflow))
+    try:
+        journal.forget(workflow.journal_file)
+        report = load_run_report(workflow.output_directory)
+        plan = []
+        _run(workflow, mapper, dry_run, report, plan, profiling, trace_memory)
+        if dry_run:
+            # Do not let the planned files leak into a subsequent run.
+            dir_index.invalidate_tree(workflow.output_directory)
+            return plan
+        save_run_report(workflow.output_directory, report)
+    finally:
+        dir_index.end_run()
+
+def _input_paths(workflow):
+    """Return the input directories and files of a workflow and its nodes."""
+    paths = []
+
+    def add_paths(input_obj):
+        if isinstance(input_obj, basestring):
+            paths.append(input_obj)
+        elif isinstance(input_obj, (tuple, list)):
+            for iobj in input_obj:
+                add_paths(iobj)
+
+    nodes = [workflow]
+    while nodes:
+        node = nodes.pop()
+        add_paths(getattr(node, 'input_obj', None))
+        nodes.extend(node.nodes)
+    return paths
+
+def _implements_process(node):
+    """Whether or not the node overrides process() rather than using tasks."""
+    return type(node).process.__func__ is not _BaseNode.process.__func__
+
+def _stale_outputs(node):
+    """Return the stale outputs of a node and their number.
+
+    The number is None if the node does not know its stale outputs.
+    """
+    try:
+        stale_outputs = node.stale_outputs()
+    except NotImplementedError:
+        return [], None
+    return stale_outputs, len(stale_outputs)
+
+def _run(workflow, mapper, dry_run, report, plan, profiling=None,
+         trace_memory=False):
+    """Recursive implementation of :func:`workflow.run`."""
+    if dry_run:
+        dir_index.plan_directory(workflow.output_directory)
+    elif not os.path.isdir(workflow.output_directory):
         os.mkdir(workflow.output_directory)
+        dir_index.invalidate(os.path.dirname(workflow.output_directory))
 
     if len(workflow.nodes) > 0:
         for node in workflow.nodes:
-            run(node, mapper=mapper)
+            _run(node, mapper, dry_run, report, plan, profiling,
+                 trace_memory)
+        return
+
+    name = node_name(workflow)
+    if dry_run:
+        stale_outputs, num_tasks = _stale_outputs(workflow)
+        for outputs in stale_outputs:
+            if isinstance(outputs, basestring):
+                outputs = [outputs]
+            for fpath in outputs:
+                dir_index.plan(fpath)
+        estimate = _estimate_seconds(report.get(name), num_tasks)
+        plan.append(PlanEntry(name, num_tasks, estimate))
+        return
+
+    profile = profiling is not None and profiling.selects(workflow)
+    start = time.time()
+    if _implements_process(workflow):
+        # Only the node knows whether process() has any work to do; the
+        # number of tasks of the other nodes comes from get_tasks().
+        _, num_tasks = _stale_outputs(workflow)
+        # The tasks of the other nodes hold their resources in the mapper.
+        with _reserve(mapper, workflow):
+            _, raw_stats, usage = _tracked_call(workflow.process, (),
+                                                profile, trace_memory)
+        usages = [usage]
+        if raw_stats is not None:
+            profiling.add(name, raw_stats)
     else:
-        try:
-            workflow.process()
-        except NotImplementedError:
-            mapper(workflow.execute, workflow.get_tasks())
+        tasks = workflow.get_tasks()
+        num_tasks = len(tasks)
+        if profile:
+            selected = profiling.sample(tasks)
+        else:
+            selected = [False] * len(tasks)
+        items = [(task, p, trace_memory) for task, p in zip(tasks, selected)]
+        usages = []
+        for raw_stats, usage in mapper(workflow.tracked_task, items):
+            usages.append(usage)
+            if raw_stats is not None:
+                profiling.add(name, raw_stats)
+    if num_tasks:
+        entry = {'tasks': num_tasks, 'seconds': time.time() - start}
+        entry.update(_peak_usage(usages))
+        logger.info('{}: {}'.format(name, entry))
+        report[name] = entry
+
+    # Make the outputs of this node visible to the nodes downstream.
+    dir_index.invalidate(workflow.output_directory)
+    if isinstance(workflow, _OutOne):
+        dir_index.record(workflow.output_file)
         
 #############################################################################
 # Settings.
@@ -198,6 +1008,17 @@ class _BaseNode(object):
         """
         raise NotImplementedError
 
+    def stale_outputs(self):
+        """Return list of outputs that processing the node would (re)write.
+
+        One item per task; an item is either a file path or a list of file
+        paths. Used to plan a run without executing anything.
+
+        Override this function alongside process() to support dry runs of
+        nodes that do not implement get_tasks.
+        """
+        return [task.output_file for task in self.get_tasks()]
+
     def execute(self, task_input):
         """Execute a single task.
         
@@ -208,6 +1029,89 @@ class _BaseNode(object):
         """
         raise NotImplementedError
 
+    def run_task(self, task_input):
+        """Execute a single task writing its output atomically.
+
+        Tasks without an output_file are executed as they are.
+        """
+        output_file = getattr(task_input, 'output_file', None)
+        if not isinstance(output_file, basestring):
+            return self.execute(task_input)
+        with self.atomic_output(output_file) as partial_file:
+            return self.execute(task_input._replace(output_file=partial_file))
+
+    def tracked_task(self, item):
+        """Execute a (task, profile, trace_memory) tuple.
+
+        See :class:`workflow.Profiling` and :func:`workflow.memory_call`.
+
+        :returns: tuple of the raw profile statistics of the task if profile
+                  is True, otherwise None, and its memory usage
+        """
+        task_input, profile, trace_memory = item
+        _, raw_stats, usage = _tracked_call(self.run_task, (task_input,),
+                                            profile, trace_memory)
+        return raw_stats, usage
+
+    @property
+    def journal_file(self):
+        """Return the path to the journal of the top-level node."""
+        if self._parent is None:
+            return os.path.join(os.path.abspath(self.output_directory),
+                                JOURNAL_FNAME)
+        return self._parent.journal_file
+
+    @contextmanager
+    def atomic_output(self, output_file):
+        """Context manager yielding a temporary path to write an output to.
+
+        On success the temporary file is renamed to the output file and the
+        output is recorded in the journal. A crash therefore never leaves a
+        partially written output file behind.
+
+        The temporary file name keeps the extension of the output file so
+        that the file format can be inferred from it.
+        """
+        directory, fname = os.path.split(output_file)
+        partial_file = FilePath(os.path.join(directory, '{}{}-{}'.format(
+            PARTIAL_PREFIX, os.getpid(), fname)))
+        try:
+            yield partial_file
+        except BaseException:
+            if os.path.isfile(partial_file):
+                os.unlink(partial_file)
+            raise
+        if os.path.isfile(partial_file):
+            os.rename(partial_file, output_file)
+            journal.record(self.journal_file, output_file)
+
+    def output_is_up_to_date(self, output_file, *input_files):
+        """Wether or not the output is complete and newer than the inputs.
+
+        An output recorded in the journal was written by the workflow after
+        its inputs, so it is also up to date with inputs that have the same
+        modification time, which is common on file systems with a coarse
+        time resolution. The journal is only trusted while the output on
+        disk still has the modification time it was recorded with; entries
+        of outputs that have since been deleted or replaced are dropped.
+
+        In dry runs an output planned by an upstream node is going to be
+        written through :func:`_BaseNode.atomic_output` too, after its
+        inputs, so it is treated like a journaled output.
+        """
+        journal_mtime = journal.getmtime(self.journal_file, output_file)
+        if not dir_index.isfile(output_file):
+            if journal_mtime is not None:
+                journal.discard(self.journal_file, output_file)
+            return False
+        mtime = dir_index.getmtime(output_file)
+        if journal_mtime is not None and journal_mtime != mtime:
+            journal.discard(self.journal_file, output_file)
+            journal_mtime = None
+        if journal_mtime is not None or mtime == PLANNED_MTIME:
+            return all(mtime >= dir_index.getmtime(f) for f in input_files)
+        return all(mtime > dir_index.getmtime(f) for f in input_files)
+
     def add_node(self, node):
         """Add a node to the meta node.
 
@@ -231,11 +1135,11 @@ class FilePath(str):
     @property
     def exists(self):
         """Wether or not the file exists."""
-        return os.path.isfile(self)
+        return dir_index.isfile(self)
 
     def is_more_recent_than(self, other):
         """Wether or not the file is more recent than the other file."""
-        return os.path.getmtime(self) > os.path.getmtime(other)
+        return dir_index.getmtime(self) > dir_index.getmtime(other)
 
 class _InOne(object):
     """Base class for nodes that take one input."""
@@ -290,7 +1194,7 @@ class _InMany(object):
             else:
                 # At this point we assume that we have been given a path to an
                 # input directory.
-                for fname in os.listdir(input_obj):
+                for fname in dir_index.listdir(input_obj):
                     yield FilePath(os.path.join(input_obj, fname))
 
         return [f for f in yield_files(self.input_obj)]
@@ -305,7 +1209,7 @@ class _OutMany(object):
         :returns: list of :class:`workflow.FilePath` instances
         """
         return [FilePath(os.path.join(self.output_directory, fname))
-                for fname in os.listdir(self.output_directory)]
+                for fname in dir_index.listdir(self.output_directory)]
 
     def get_output_file(self, fname, enumerator=None):
         """Returns output file name.
@@ -370,7 +1274,7 @@ class ManyToManyNode(_BaseNode, _InMany, _OutMany):
         tasks = []
         for input_fn in self.input_files:
             output_fn = self.get_output_file(input_fn)
-            if output_fn.exists and output_fn.is_more_recent_than(input_fn):
+            if self.output_is_up_to_date(output_fn, input_fn):
                 continue
             tasks.append(Task(input_fn, self.get_output_file(input_fn), self.settings))
         return tasks